@@ -1,37 +1,176 @@
 import asyncio
-from aiogram import Bot, Dispatcher, types, F
-from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
+import html
+import io
+import json
+import multiprocessing
+import random
+import shutil
+import socket
+import tempfile
+import time
+import zipfile
+from contextvars import ContextVar
+from aiogram import Bot, Dispatcher, BaseMiddleware, types, F
+from aiogram.types import BufferedInputFile, InputFile, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.filters import Command
 from aiogram.enums import ParseMode
-from sqlalchemy import create_engine, Column, Integer, String, Date, ForeignKey, DateTime
-from sqlalchemy.orm import sessionmaker, declarative_base, relationship
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.methods import AnswerCallbackQuery, TelegramMethod
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+from sqlalchemy import Column, Integer, String, Date, ForeignKey, DateTime, Index, bindparam, case, delete, func, inspect, literal, or_, select, tuple_, update
+from sqlalchemy import event as sa_event
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.orm import declarative_base, relationship, joinedload
 from datetime import datetime, date, timedelta
+from collections import OrderedDict, namedtuple
 from dotenv import load_dotenv
 import os
 import csv
+import functools
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from apscheduler.jobstores.base import JobLookupError
 
 # --- Настройка окружения --- #
 load_dotenv()
 TOKEN = ""
 ADMIN_IDS = list(map(int, os.getenv("ADMIN_IDS", "").split(",")))
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling или webhook
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")  # внешний https-адрес бота
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WORKERS = int(os.getenv("WORKERS", "1"))  # больше одного - только в режиме webhook
+CACHE_SYNC_SECONDS = float(os.getenv("CACHE_SYNC_SECONDS", "1"))
+LEADER_TTL_SECONDS = float(os.getenv("LEADER_TTL_SECONDS", "15"))
+LEADER_RENEW_SECONDS = float(os.getenv("LEADER_RENEW_SECONDS", "5"))
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "10"))  # апдейтов в обработке одновременно
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))  # апдейтов в ожидании
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", "1"))  # нажатий в секунду на пользователя и обработчик
+THROTTLE_BURST = int(os.getenv("THROTTLE_BURST", "3"))
+THROTTLE_MAX_KEYS = int(os.getenv("THROTTLE_MAX_KEYS", "10000"))
+THROTTLE_EXEMPT_ADMINS = os.getenv("THROTTLE_EXEMPT_ADMINS", "1") == "1"
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT = int(os.getenv("SQLITE_BUSY_TIMEOUT", "5000"))  # мс
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", "-20000"))  # < 0 - размер в КиБ
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(128 * 1024 * 1024)))
+SQLITE_TEMP_STORE = os.getenv("SQLITE_TEMP_STORE", "MEMORY")
+SQLITE_MAINTENANCE_MINUTES = int(os.getenv("SQLITE_MAINTENANCE_MINUTES", "30"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "3600"))  # секунды
+KEYBOARD_CACHE_SIZE = int(os.getenv("KEYBOARD_CACHE_SIZE", "1000"))
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "1000"))  # строк из курсора БД за раз
+EXPORT_SPOOL_BYTES = int(os.getenv("EXPORT_SPOOL_BYTES", str(8 * 1024 * 1024)))  # дальше - во временный файл
+EXPORT_MAX_BYTES = int(os.getenv("EXPORT_MAX_BYTES", "50000000"))  # лимит Bot API на документ
+IMPORT_BATCH = int(os.getenv("IMPORT_BATCH", "500"))  # мероприятий в одной транзакции
+IMPORT_MAX_BYTES = int(os.getenv("IMPORT_MAX_BYTES", str(20 * 1024 * 1024)))  # лимит Bot API на скачивание
+IMPORT_REPORT_LINES = int(os.getenv("IMPORT_REPORT_LINES", "10"))  # ошибок в тексте ответа
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "10"))  # мероприятий и записей на странице
+PARTICIPANTS_PAGE_SIZE = int(os.getenv("PARTICIPANTS_PAGE_SIZE", "50"))
+REGISTRATION_DELETE_BATCH = int(os.getenv("REGISTRATION_DELETE_BATCH", "5000"))
+FANOUT_CONCURRENCY = int(os.getenv("FANOUT_CONCURRENCY", "20"))
+FANOUT_GLOBAL_RATE = float(os.getenv("FANOUT_GLOBAL_RATE", "25"))  # доля общего лимита для рассылок
+BOT_API_GLOBAL_RATE = float(os.getenv("BOT_API_GLOBAL_RATE", "30"))  # запросов в секунду на бота
+BOT_API_PER_CHAT_RATE = float(os.getenv("BOT_API_PER_CHAT_RATE", "1"))  # запросов в секунду в один чат
+BOT_API_CHAT_BURST = int(os.getenv("BOT_API_CHAT_BURST", "3"))
+BOT_API_MAX_CHATS = int(os.getenv("BOT_API_MAX_CHATS", "10000"))  # отслеживаемых чатов
+FANOUT_MAX_RETRIES = int(os.getenv("FANOUT_MAX_RETRIES", "3"))
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "500"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "3"))
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "5"))
+OUTBOX_RETRY_SECONDS = float(os.getenv("OUTBOX_RETRY_SECONDS", "30"))  # первый повтор, дальше вдвое дольше
+OUTBOX_RESULTS_BATCH = int(os.getenv("OUTBOX_RESULTS_BATCH", "50"))  # статусов в одной транзакции
+OUTBOX_RETENTION_DAYS = int(os.getenv("OUTBOX_RETENTION_DAYS", "7"))
+BROADCAST_PROGRESS_SECONDS = float(os.getenv("BROADCAST_PROGRESS_SECONDS", "5"))
+# Смещения напоминаний до начала мероприятия: d - дни, h - часы, m - минуты
+REMINDER_OFFSETS = [o.strip() for o in os.getenv("REMINDER_OFFSETS", "7d,1d,2h").split(",") if o.strip()]
+# У мероприятий хранится только дата, время начала общее
+EVENT_START_TIME = datetime.strptime(os.getenv("EVENT_START_TIME", "10:00"), "%H:%M").time()
+REMINDER_SPREAD_SECONDS = int(os.getenv("REMINDER_SPREAD_SECONDS", "600"))
+REMINDER_MISFIRE_GRACE = int(os.getenv("REMINDER_MISFIRE_GRACE", "3600"))
 
-bot = Bot(token=TOKEN)
+class CachedMarkupSession(AiohttpSession):
+    # Клавиатуры из реестра уходят готовым JSON, без повторной сериализации (см. detach_cached_markup)
+    def build_form_data(self, bot, method):
+        method, payload = detach_cached_markup(method)
+        form = super().build_form_data(bot, method)
+        if payload is not None:
+            form.add_field("reply_markup", payload)
+        return form
+
+bot = Bot(token=TOKEN, session=CachedMarkupSession())
 dp = Dispatcher()
-scheduler = AsyncIOScheduler()
+# Напоминания хранятся в events.db и переживают перезапуск
+reminder_jobstore = SQLAlchemyJobStore(
+    url="sqlite:///events.db",
+    engine_options={"connect_args": {"timeout": SQLITE_BUSY_TIMEOUT / 1000}}
+)
+scheduler = AsyncIOScheduler(jobstores={
+    "default": {"type": "memory"},
+    "reminders": reminder_jobstore
+})
 
 # --- Настройка БД --- #
 Base = declarative_base()
-engine = create_engine("sqlite:///events.db")
-Session = sessionmaker(bind=engine)
+
+db_pool_stats = {"checkouts": 0, "wait_seconds": 0.0, "timeouts": 0}
+
+class MeteredPool(AsyncAdaptedQueuePool):
+    # Считаем выдачи соединений и время ожидания свободного соединения
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            db_pool_stats["timeouts"] += 1
+            raise
+        finally:
+            db_pool_stats["checkouts"] += 1
+            db_pool_stats["wait_seconds"] += time.perf_counter() - started
+
+engine = create_async_engine(
+    "sqlite+aiosqlite:///events.db",
+    poolclass=MeteredPool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT
+)
+Session = async_sessionmaker(engine, expire_on_commit=False)
+
+SQLITE_PRAGMAS = {
+    "busy_timeout": SQLITE_BUSY_TIMEOUT,
+    "journal_mode": SQLITE_JOURNAL_MODE,
+    "synchronous": SQLITE_SYNCHRONOUS,
+    "cache_size": SQLITE_CACHE_SIZE,
+    "mmap_size": SQLITE_MMAP_SIZE,
+    "temp_store": SQLITE_TEMP_STORE,
+}
+
+@sa_event.listens_for(engine.sync_engine, "connect")
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
 
 class User(Base):
     __tablename__ = 'users'
     id = Column(Integer, primary_key=True)
     tg_id = Column(Integer, unique=True)
     full_name = Column(String)
-    registrations = relationship("Registration", back_populates="user")
+    registrations = relationship("Registration", back_populates="user", lazy="raise")
 
 class Event(Base):
     __tablename__ = 'events'
@@ -39,19 +178,287 @@ class Event(Base):
     title = Column(String)
     topic = Column(String)
     description = Column(String)
-    date = Column(Date)
-    registrations = relationship("Registration", back_populates="event")
+    date = Column(Date, index=True)
+    # Денормализованный счетчик, меняется в одной транзакции с записями
+    registrations_count = Column(Integer, nullable=False, default=0, server_default="0")
+    # Растет при каждом изменении состава участников, по нему проверяется кэш экспорта
+    registrations_version = Column(Integer, nullable=False, default=0, server_default="0")
+    registrations = relationship("Registration", back_populates="event", lazy="raise")
 
 class Registration(Base):
     __tablename__ = 'registrations'
+    __table_args__ = (
+        Index('ix_registrations_event_user', 'event_id', 'user_id', unique=True),
+        Index('ix_registrations_user_id', 'user_id'),
+        # Участники мероприятия по порядку записи - для постраничного вывода
+        Index('ix_registrations_event_id', 'event_id', 'id'),
+    )
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'))
     event_id = Column(Integer, ForeignKey('events.id'))
     registered_at = Column(DateTime, default=datetime.utcnow)
-    user = relationship("User", back_populates="registrations")
-    event = relationship("Event", back_populates="registrations")
+    # lazy="raise": связи подгружаются только явно (joinedload), без N+1
+    user = relationship("User", back_populates="registrations", lazy="raise")
+    event = relationship("Event", back_populates="registrations", lazy="raise")
+
+class OutboxMessage(Base):
+    # Очередь исходящих сообщений: pending -> sending -> sent / failed
+    __tablename__ = 'outbox'
+    __table_args__ = (
+        Index('ix_outbox_status_id', 'status', 'id'),
+        Index('ix_outbox_broadcast', 'broadcast_id', 'status'),
+    )
+    id = Column(Integer, primary_key=True)
+    idempotency_key = Column(String, unique=True, nullable=False)
+    chat_id = Column(Integer, nullable=False)
+    text = Column(String, nullable=False)
+    status = Column(String, nullable=False, default="pending", server_default="pending")
+    attempts = Column(Integer, nullable=False, default=0, server_default="0")
+    last_error = Column(String)
+    not_before = Column(DateTime)
+    broadcast_id = Column(Integer)  # paused - сообщение приостановленной рассылки
+    created_at = Column(DateTime, default=datetime.utcnow)
+    sent_at = Column(DateTime)
+
+class Broadcast(Base):
+    # Рассылка администратора: running -> paused -> running ... -> done; сообщения лежат в outbox
+    __tablename__ = 'broadcasts'
+    id = Column(Integer, primary_key=True)
+    text = Column(String, nullable=False)
+    event_id = Column(Integer)  # None - всем пользователям
+    status = Column(String, nullable=False, default="running")
+    total = Column(Integer, nullable=False, default=0)
+    chat_id = Column(Integer, nullable=False)  # где показывать прогресс
+    message_id = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime)
+
+class CacheVersion(Base):
+    # Версии кэшей, общие для всех воркеров
+    __tablename__ = 'cache_versions'
+    name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+class LeaderLock(Base):
+    # Аренда лидерства: планировщик и очередь сообщений работают только у владельца
+    __tablename__ = 'leader_lock'
+    name = Column(String, primary_key=True)
+    owner = Column(String, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+
+class ExportCache(Base):
+    # Уже загруженный в Telegram экспорт мероприятия: пока версия та же, документы уходят по file_id
+    __tablename__ = 'export_cache'
+    event_id = Column(Integer, primary_key=True)
+    registrations_version = Column(Integer, nullable=False)
+    participants = Column(Integer, nullable=False)
+    file_ids = Column(String, nullable=False)  # через пробел, в порядке отправки
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+# --- Миграции --- #
+def add_column_if_missing(table, column, ddl):
+    # Таблицу могла уже создать create_all вместе с новой колонкой
+    def migrate(sync_conn):
+        if column not in {c["name"] for c in inspect(sync_conn).get_columns(table)}:
+            sync_conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+    return migrate
+
+# Каждый элемент - одна версия схемы (PRAGMA user_version), только дописывать в конец
+MIGRATIONS = [
+    # 1: индексы и уникальность записей
+    [
+        "DELETE FROM registrations WHERE id NOT IN "
+        "(SELECT MIN(id) FROM registrations GROUP BY event_id, user_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_registrations_event_user ON registrations (event_id, user_id)",
+        "CREATE INDEX IF NOT EXISTS ix_registrations_user_id ON registrations (user_id)",
+        "CREATE INDEX IF NOT EXISTS ix_events_date ON events (date)",
+    ],
+    # 2: счетчик записей на мероприятии
+    [
+        "ALTER TABLE events ADD COLUMN registrations_count INTEGER NOT NULL DEFAULT 0",
+        "UPDATE events SET registrations_count = "
+        "(SELECT COUNT(*) FROM registrations WHERE registrations.event_id = events.id)",
+    ],
+    # 3: записи, осиротевшие после старого удаления мероприятий
+    [
+        "DELETE FROM registrations WHERE event_id IS NULL "
+        "OR event_id NOT IN (SELECT id FROM events)",
+    ],
+    # 4: отложенная отправка из очереди
+    [
+        add_column_if_missing("outbox", "not_before", "DATETIME"),
+    ],
+    # 5: постраничный вывод участников
+    [
+        "CREATE INDEX IF NOT EXISTS ix_registrations_event_id ON registrations (event_id, id)",
+    ],
+    # 6: версия состава участников для кэша экспорта
+    [
+        add_column_if_missing("events", "registrations_version", "INTEGER NOT NULL DEFAULT 0"),
+    ],
+    # 7: рассылки администратора
+    [
+        add_column_if_missing("outbox", "broadcast_id", "INTEGER"),
+        "CREATE INDEX IF NOT EXISTS ix_outbox_broadcast ON outbox (broadcast_id, status)",
+    ],
+]
+
+async def run_migrations(conn, fresh=False):
+    if fresh:
+        # create_all уже создал актуальную схему
+        await conn.exec_driver_sql(f"PRAGMA user_version = {len(MIGRATIONS)}")
+        return
+    
+    version = (await conn.exec_driver_sql("PRAGMA user_version")).scalar()
+    for number, statements in enumerate(MIGRATIONS[version:], version + 1):
+        for statement in statements:
+            if callable(statement):
+                await conn.run_sync(statement)
+            else:
+                await conn.exec_driver_sql(statement)
+        await conn.exec_driver_sql(f"PRAGMA user_version = {number}")
+        print(f"БД обновлена до версии схемы {number}")
+
+async def init_db():
+    async with engine.begin() as conn:
+        fresh = not await conn.run_sync(lambda sync_conn: inspect(sync_conn).has_table("events"))
+        await conn.run_sync(Base.metadata.create_all)
+        # Таблицу задач создаем заранее, чтобы воркеры не создавали ее одновременно
+        await conn.run_sync(reminder_jobstore.jobs_t.create, checkfirst=True)
+        await run_migrations(conn, fresh)
+
+async def sqlite_maintenance():
+    # Периодически сбрасываем WAL в основной файл и обновляем статистику планировщика
+    async with engine.connect() as conn:
+        if SQLITE_JOURNAL_MODE.upper() == "WAL":
+            await conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+        await conn.exec_driver_sql("PRAGMA optimize")
+    
+    async with Session() as session:
+        await session.execute(
+            delete(OutboxMessage)
+            .where(OutboxMessage.status == "sent")
+            .where(OutboxMessage.sent_at < datetime.utcnow() - timedelta(days=OUTBOX_RETENTION_DAYS))
+        )
+        await session.commit()
+
+# --- Middleware --- #
+update_queue_stats = {"waiting": 0, "active": 0, "max_waiting": 0, "processed": 0,
+                      "rejected": 0, "wait_seconds": 0.0, "max_wait": 0.0}
 
-Base.metadata.create_all(engine)
+class UpdateQueueMiddleware(BaseMiddleware):
+    # Ограниченный пул обработчиков; апдейты одного чата строго по порядку, разных чатов - параллельно
+    def __init__(self, workers, max_waiting, send_results):
+        self.slots = asyncio.Semaphore(workers)
+        self.max_waiting = max_waiting
+        # В polling ответ обработчика отправляется здесь, пока занята очередь чата и слот пула,
+        # иначе ответы одному чату могли бы уйти не по порядку; в webhook - только ждет лимитов
+        self.send_results = send_results
+        self.lanes = {}
+
+    async def __call__(self, handler, event, data):
+        stats = update_queue_stats
+        if stats["waiting"] >= self.max_waiting:
+            # В режиме webhook Telegram повторит доставку позже
+            stats["rejected"] += 1
+            raise RuntimeError("Очередь апдейтов переполнена")
+        
+        chat = data.get("event_chat") or data.get("event_from_user")
+        key = chat.id if chat else None
+        lane = self.lanes.get(key)
+        if lane is None:
+            lane = self.lanes[key] = [asyncio.Lock(), 0]
+        lane[1] += 1
+        
+        started = time.monotonic()
+        waiting = True
+        stats["waiting"] += 1
+        stats["max_waiting"] = max(stats["max_waiting"], stats["waiting"])
+        try:
+            async with lane[0], self.slots:
+                waiting = False
+                stats["waiting"] -= 1
+                waited = time.monotonic() - started
+                stats["wait_seconds"] += waited
+                stats["max_wait"] = max(stats["max_wait"], waited)
+                stats["active"] += 1
+                try:
+                    result = await handler(event, data)
+                    if isinstance(result, TelegramMethod):
+                        if self.send_results:
+                            await Dispatcher.silent_call_request(data["bot"], result)
+                            return None
+                        await reserve_webhook_reply(result)
+                    return result
+                finally:
+                    stats["active"] -= 1
+                    stats["processed"] += 1
+        finally:
+            if waiting:
+                stats["waiting"] -= 1
+            lane[1] -= 1
+            if not lane[1]:
+                del self.lanes[key]
+
+class DbSessionMiddleware(BaseMiddleware):
+    # Одна сессия на апдейт: коммит при успехе, откат при ошибке, закрытие всегда
+    def __init__(self, session_pool):
+        self.session_pool = session_pool
+
+    async def __call__(self, handler, event, data):
+        async with self.session_pool() as session:
+            data["session"] = session
+            try:
+                result = await handler(event, data)
+            except Exception:
+                await session.rollback()
+                raise
+            await session.commit()
+            return result
+
+throttle_stats = {"passed": 0, "dropped": 0}
+
+class ThrottlingMiddleware(BaseMiddleware):
+    # Лимит нажатий на пару (пользователь, обработчик); бакет - кортеж (токены, время) в LRU
+    def __init__(self, rate, burst, max_keys):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+
+    def allow(self, key):
+        now = time.monotonic()
+        tokens, updated = self.buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self.buckets[key] = (tokens, now)
+        if len(self.buckets) > self.max_keys:
+            self.buckets.popitem(last=False)
+        return allowed
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None or (THROTTLE_EXEMPT_ADMINS and is_admin(user.id)):
+            return await handler(event, data)
+        if self.allow((user.id, data["handler"].callback.__name__)):
+            throttle_stats["passed"] += 1
+            return await handler(event, data)
+        
+        # Лишние нажатия не доходят ни до БД, ни до Bot API
+        throttle_stats["dropped"] += 1
+        if isinstance(event, types.CallbackQuery):
+            # Иначе на кнопке так и будут крутиться часики
+            return event.answer("⏳ Слишком часто, подождите немного")
+
+# Очередь раньше сессии: ожидающий апдейт не держит соединение с БД
+dp.update.outer_middleware(UpdateQueueMiddleware(UPDATE_WORKERS, UPDATE_QUEUE_SIZE, send_results=BOT_MODE != "webhook"))
+dp.update.outer_middleware(DbSessionMiddleware(Session))
+# Внутренний middleware: обработчик уже выбран, сессия еще не обращалась к БД
+throttling = ThrottlingMiddleware(THROTTLE_RATE, THROTTLE_BURST, THROTTLE_MAX_KEYS)
+dp.message.middleware(throttling)
+dp.callback_query.middleware(throttling)
 
 # --- Вспомогательные функции --- #
 def is_admin(user_id):
@@ -69,12 +476,111 @@ def format_event_full(event):
             f"📝 Описание:\n{event.description}\n\n"
             f"🆔 ID мероприятия: <code>{event.id}</code>")
 
+def event_participants_query(event_id):
+    # Участники мероприятия одним JOIN-запросом
+    return (select(User.tg_id, User.full_name, Registration.registered_at)
+            .join(Registration.user)
+            .where(Registration.event_id == event_id)
+            .order_by(Registration.id))
+
+def change_registrations_count(event_id, delta):
+    return (update(Event)
+            .where(Event.id == event_id)
+            .values(registrations_count=Event.registrations_count + delta,
+                    registrations_version=Event.registrations_version + 1))
+
+async def delete_user_registrations(session, user_id):
+    # Пользователь записан на мероприятие не более одного раза, поэтому счетчик уменьшаем на 1
+    await session.execute(
+        update(Event)
+        .where(Event.id.in_(select(Registration.event_id).where(Registration.user_id == user_id)))
+        .values(registrations_count=Event.registrations_count - 1,
+                registrations_version=Event.registrations_version + 1),
+        execution_options={"synchronize_session": False}
+    )
+    result = await session.execute(
+        delete(Registration).where(Registration.user_id == user_id),
+        execution_options={"synchronize_session": False}
+    )
+    return result.rowcount
+
+async def delete_event_with_registrations(session, event_id):
+    # Записи большого мероприятия удаляем пачками с коммитом между ними,
+    # чтобы не держать блокировку записи SQLite надолго
+    deleted_registrations = 0
+    while True:
+        batch = (select(Registration.id)
+                 .where(Registration.event_id == event_id)
+                 .limit(REGISTRATION_DELETE_BATCH)
+                 .scalar_subquery())
+        result = await session.execute(
+            delete(Registration).where(Registration.id.in_(batch)),
+            execution_options={"synchronize_session": False}
+        )
+        deleted_registrations += result.rowcount
+        if result.rowcount < REGISTRATION_DELETE_BATCH:
+            break
+        await session.execute(change_registrations_count(event_id, -result.rowcount))
+        await session.commit()
+    
+    await session.execute(delete(ExportCache).where(ExportCache.event_id == event_id))
+    title = await session.scalar(delete(Event).where(Event.id == event_id).returning(Event.title))
+    await session.commit()
+    return title, deleted_registrations
+
 def format_registration(reg):
     return (f"• {reg.event.title} (ID: {reg.event.id})\n"
             f"  Дата: {reg.event.date.strftime('%d.%m.%Y')}\n"
             f"  Зарегистрирован: {reg.registered_at.strftime('%d.%m.%Y %H:%M')}")
 
 # --- Клавиатуры --- #
+class KeyboardRegistry:
+    # Собранные клавиатуры и их JSON; постоянные хранятся всегда, остальные - в LRU
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.pinned = {}
+        self.recent = OrderedDict()
+        self.payloads = {}  # id(клавиатуры) -> JSON для Bot API
+
+    def get(self, key, build, pinned=False):
+        markup = self.pinned.get(key)
+        if markup is not None:
+            return markup
+        markup = self.recent.get(key)
+        if markup is not None:
+            self.recent.move_to_end(key)
+            return markup
+        
+        markup = build()
+        self.payloads[id(markup)] = bot.session.prepare_value(markup, bot=bot, files={})
+        if pinned:
+            self.pinned[key] = markup
+        else:
+            self.recent[key] = markup
+            if len(self.recent) > self.maxsize:
+                _, evicted = self.recent.popitem(last=False)
+                self.payloads.pop(id(evicted), None)
+        return markup
+
+keyboards = KeyboardRegistry(KEYBOARD_CACHE_SIZE)
+
+def registered_keyboard(pinned=False):
+    # Клавиатура собирается один раз для каждого набора аргументов
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args):
+            return keyboards.get((func.__name__, *args), lambda: func(*args), pinned)
+        return wrapper
+    return decorator
+
+def detach_cached_markup(method):
+    # Метод без клавиатуры и ее готовый JSON, если клавиатура из реестра
+    payload = keyboards.payloads.get(id(getattr(method, "reply_markup", None)))
+    if payload is None:
+        return method, None
+    return method.model_copy(update={"reply_markup": None}), payload
+
+@registered_keyboard(pinned=True)
 def get_main_keyboard(is_admin=False):
     buttons = [
         [KeyboardButton(text="📅 Предстоящие мероприятия")],
@@ -86,20 +592,23 @@ def get_main_keyboard(is_admin=False):
         buttons.insert(0, [KeyboardButton(text="🛠️ Админ-панель")])
     return ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
 
+@registered_keyboard(pinned=True)
 def get_admin_keyboard():
     buttons = [
         [KeyboardButton(text="➕ Создать мероприятие")],
         [KeyboardButton(text="📤 Экспорт записей")],
+        [KeyboardButton(text="📦 Экспорт всех мероприятий")],
         [KeyboardButton(text="🗑️ Удалить мероприятие")],
         [KeyboardButton(text="👥 Участники")],
         [KeyboardButton(text="🔙 Главное меню")]
     ]
     return ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
 
+@registered_keyboard(pinned=True)
 def get_back_keyboard():
     return ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="🔙 Назад")]], resize_keyboard=True)
 
-def get_event_list_keyboard(events):
+def get_event_list_keyboard(events, navigation=()):
     builder = InlineKeyboardBuilder()
     for event in events:
         builder.button(
@@ -107,8 +616,11 @@ def get_event_list_keyboard(events):
             callback_data=f"event_select_{event.id}"
         )
     builder.adjust(1)
+    if navigation:
+        builder.row(*navigation)
     return builder.as_markup()
 
+@registered_keyboard()
 def get_event_details_keyboard(event_id, is_registered=False):
     builder = InlineKeyboardBuilder()
     
@@ -130,25 +642,283 @@ def get_event_details_keyboard(event_id, is_registered=False):
     builder.adjust(1)
     return builder.as_markup()
 
+# --- Постраничные списки --- #
+# Keyset-пагинация: страница начинается после курсора (n) или заканчивается перед ним (p),
+# курсор - значения колонок сортировки крайней строки соседней страницы
+def paginate(query, columns, direction, cursor, limit):
+    query = query.order_by(None)
+    if direction == "p":
+        query = query.where(tuple_(*columns) < cursor).order_by(*(column.desc() for column in columns))
+    else:
+        if cursor is not None:
+            query = query.where(tuple_(*columns) > cursor)
+        query = query.order_by(*columns)
+    # Лишняя строка показывает, есть ли что-то дальше
+    return query.limit(limit + 1)
+
+def split_page(rows, direction, cursor, limit):
+    # Возвращает (строки, есть ли предыдущая страница, есть ли следующая)
+    rows = list(rows)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == "p":
+        rows.reverse()
+        return rows, has_more, True
+    return rows, cursor is not None, has_more
+
+def page_navigation(prefix, has_prev, has_next, first, last):
+    # first и last - курсоры первой и последней строки страницы
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"{prefix}:p:{first}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton(text="Далее ➡️", callback_data=f"{prefix}:n:{last}"))
+    return buttons
+
+async def get_my_events_view(session, user_id, direction="n", cursor=None):
+    regs, has_prev, has_next = split_page(await session.scalars(paginate(
+        select(Registration).filter_by(user_id=user_id).options(joinedload(Registration.event)),
+        [Registration.id], direction, cursor, PAGE_SIZE
+    )), direction, cursor, PAGE_SIZE)
+    if not regs:
+        # Страница могла опустеть после отмены записей
+        return await get_my_events_view(session, user_id) if cursor is not None else (None, None)
+    
+    text = "🎫 <b>Ваши мероприятия:</b>\n\n"
+    for reg in regs:
+        text += format_registration(reg) + "\n\n"
+    
+    builder = InlineKeyboardBuilder()
+    for reg in regs:
+        builder.button(
+            text=f"❌ Отменить {reg.event.title}",
+            callback_data=f"cancel_{reg.id}"
+        )
+    builder.adjust(1)
+    navigation = page_navigation("mypage", has_prev, has_next, regs[0].id, regs[-1].id)
+    if navigation:
+        builder.row(*navigation)
+    return text, builder.as_markup()
+
+async def get_participants_view(session, event, direction="n", cursor=None):
+    participants, has_prev, has_next = split_page((await session.execute(paginate(
+        event_participants_query(event.id).add_columns(Registration.id),
+        [Registration.id], direction, cursor, PARTICIPANTS_PAGE_SIZE
+    ))).all(), direction, cursor, PARTICIPANTS_PAGE_SIZE)
+    if not participants and cursor is not None:
+        return await get_participants_view(session, event)
+    
+    if not participants:
+        text = f"📭 На мероприятие <b>{event.title}</b> пока никто не зарегистрировался."
+    else:
+        text = (f"👥 <b>Участники мероприятия</b>\n\nМероприятие: <b>{event.title}</b>\n"
+                f"Всего участников: {event.registrations_count}\n\n")
+        for tg_id, full_name, _, _ in participants:
+            text += f"• {full_name} (ID: {tg_id})\n"
+    
+    rows = []
+    if participants:
+        navigation = page_navigation(f"uspage:{event.id}", has_prev, has_next,
+                                     participants[0].id, participants[-1].id)
+        if navigation:
+            rows.append(navigation)
+    rows.append([
+        InlineKeyboardButton(text="📤 Экспорт", callback_data=f"export_{event.id}"),
+        InlineKeyboardButton(text="🔙 Назад", callback_data="show_users")
+    ])
+    return text, InlineKeyboardMarkup(inline_keyboard=rows)
+
+# Списки выбора мероприятия в админ-панели: префикс страниц -> (заголовок, текст при пустом списке,
+# префикс кнопки мероприятия, подпись кнопки)
+EVENT_PICKERS = {
+    "expick": ("📤 <b>Экспорт участников</b>\n\nВыберите мероприятие:", "📭 Нет мероприятий для экспорта",
+               "export_", lambda event: f"{event.title} ({event.date.strftime('%d.%m.%Y')})"),
+    "delpick": ("🗑️ <b>Удаление мероприятия</b>\n\nВыберите мероприятие:", "📭 Нет мероприятий для удаления",
+                "delete_", lambda event: f"{event.title} ({event.date.strftime('%d.%m.%Y')})"),
+    "uspick": ("👥 <b>Просмотр участников</b>\n\nВыберите мероприятие:", "📭 Нет мероприятий",
+               "users_", lambda event: f"{event.title} ({event.registrations_count})"),
+}
+
+async def get_event_picker_view(session, picker, direction="n", cursor=None):
+    title, empty_text, action, label = EVENT_PICKERS[picker]
+    start = cursor is None
+    if start:
+        # Список открывается на ближайших мероприятиях, прошедшие - по кнопке «Назад»
+        direction, cursor = "n", (date.today(), 0)
+    events, has_prev, has_next = split_page(await session.scalars(paginate(
+        select(Event), [Event.date, Event.id], direction, cursor, PAGE_SIZE
+    )), direction, cursor, PAGE_SIZE)
+    if start:
+        has_prev = await session.scalar(select(Event.id).where(Event.date < cursor[0]).limit(1)) is not None
+        if not events and has_prev:
+            return await get_event_picker_view(session, picker, "p", cursor)
+    if not events:
+        # Страница могла опустеть после удаления мероприятий
+        return await get_event_picker_view(session, picker) if not start else (empty_text, None)
+    
+    builder = InlineKeyboardBuilder()
+    for event in events:
+        builder.button(text=label(event), callback_data=f"{action}{event.id}")
+    builder.adjust(1)
+    navigation = page_navigation(
+        picker, has_prev, has_next,
+        f"{events[0].date.isoformat()}:{events[0].id}", f"{events[-1].date.isoformat()}:{events[-1].id}"
+    )
+    if navigation:
+        builder.row(*navigation)
+    return title, builder.as_markup()
+
+# --- Кэш списка мероприятий --- #
+# Готовые текст и клавиатура страниц списка, ключ - (текущая дата, направление, курсор)
+upcoming_cache = {}
+upcoming_cache_stats = {"hits": 0, "misses": 0, "generation": 0}
+
+def invalidate_upcoming_cache():
+    upcoming_cache_stats["generation"] += 1
+    upcoming_cache.clear()
+
+async def get_upcoming_view(session, direction="n", cursor=None):
+    today = date.today()
+    key = (today, direction, cursor)
+    view = upcoming_cache.get(key)
+    if view is not None:
+        upcoming_cache_stats["hits"] += 1
+        return view
+    
+    upcoming_cache_stats["misses"] += 1
+    generation = upcoming_cache_stats["generation"]
+    events, has_prev, has_next = split_page(await session.scalars(paginate(
+        select(Event).filter(Event.date >= today), [Event.date, Event.id], direction, cursor, PAGE_SIZE
+    )), direction, cursor, PAGE_SIZE)
+    if not events:
+        if cursor is not None:
+            return await get_upcoming_view(session)
+        view = (None, None)
+    else:
+        text = "📅 <b>Предстоящие мероприятия:</b>\n\n"
+        for event in events:
+            text += (f"{format_event_short(event)}\n\n")
+        navigation = page_navigation(
+            "evpage", has_prev, has_next,
+            f"{events[0].date.isoformat()}:{events[0].id}", f"{events[-1].date.isoformat()}:{events[-1].id}"
+        )
+        # Клавиатура страницы привязана к версии списка
+        markup = keyboards.get(("upcoming", generation) + key,
+                               lambda: get_event_list_keyboard(events, navigation))
+        view = (text, markup)
+    
+    # Не кладем в кэш то, что устарело, пока мы читали из БД
+    if generation == upcoming_cache_stats["generation"]:
+        if any(cached_day != today for cached_day, _, _ in upcoming_cache):
+            upcoming_cache.clear()
+        upcoming_cache[key] = view
+    return view
+
+# --- Общие для воркеров версии кэшей --- #
+CACHE_INVALIDATORS = {
+    "upcoming": invalidate_upcoming_cache,
+}
+known_cache_versions = {}
+
+async def invalidate_shared_cache(session, name):
+    # Вызывается после коммита изменений: сбрасываем свой кэш и поднимаем версию для остальных
+    CACHE_INVALIDATORS[name]()
+    version = await session.scalar(
+        sqlite_insert(CacheVersion)
+        .values(name=name, version=1)
+        .on_conflict_do_update(index_elements=[CacheVersion.name], set_={"version": CacheVersion.version + 1})
+        .returning(CacheVersion.version)
+    )
+    await session.commit()
+    known_cache_versions[name] = version
+
+async def sync_cache_versions():
+    # Другие воркеры поменяли данные - сбрасываем соответствующие локальные кэши
+    while True:
+        try:
+            async with Session() as session:
+                versions = (await session.execute(select(CacheVersion.name, CacheVersion.version))).all()
+            for name, version in versions:
+                if name in CACHE_INVALIDATORS and known_cache_versions.get(name, 0) != version:
+                    CACHE_INVALIDATORS[name]()
+                known_cache_versions[name] = version
+        except Exception as e:
+            print(f"Ошибка синхронизации кэшей: {e}")
+        await asyncio.sleep(CACHE_SYNC_SECONDS)
+
+async def rollover_upcoming_cache():
+    async with Session() as session:
+        await invalidate_shared_cache(session, "upcoming")
+
+# --- Кэш пользователей --- #
+UserRef = namedtuple("UserRef", ["id", "full_name"])
+
+class LRUCache:
+    # Ограниченный по размеру кэш с временем жизни записей
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        item = self.data.get(key)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self.data[key]
+            self.misses += 1
+            return None
+        self.data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def set(self, key, value):
+        self.data[key] = (time.monotonic() + self.ttl, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key):
+        self.data.pop(key, None)
+
+    def clear(self):
+        self.data.clear()
+
+user_cache = LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+async def get_user_ref(session, tg_user):
+    # tg_id -> (id, full_name); неизвестного пользователя создаем на лету
+    ref = user_cache.get(tg_user.id)
+    if ref is not None:
+        return ref
+    
+    result = await session.execute(
+        sqlite_insert(User)
+        .values(tg_id=tg_user.id, full_name=tg_user.full_name)
+        .on_conflict_do_nothing(index_elements=[User.tg_id])
+    )
+    if result.rowcount:
+        await session.commit()
+    row = (await session.execute(select(User.id, User.full_name).filter_by(tg_id=tg_user.id))).one()
+    ref = UserRef(row.id, row.full_name)
+    user_cache.set(tg_user.id, ref)
+    return ref
+
 # --- Обработчики команд --- #
 @dp.message(Command("start"))
-async def start(message: types.Message):
-    session = Session()
-    if not session.query(User).filter_by(tg_id=message.from_user.id).first():
-        user = User(tg_id=message.from_user.id, full_name=message.from_user.full_name)
-        session.add(user)
-        session.commit()
-    session.close()
+async def start(message: types.Message, session: AsyncSession):
+    await get_user_ref(session, message.from_user)
     
     text = ("👋 Добро пожаловать в систему управления мероприятиями!\n\n"
             "📌 Используйте кнопки ниже для навигации.\n"
             "📎 Для администраторов доступны дополнительные функции")
     
-    await message.answer(text, reply_markup=get_main_keyboard(is_admin(message.from_user.id)), parse_mode=ParseMode.HTML)
+    return message.answer(text, reply_markup=get_main_keyboard(is_admin(message.from_user.id)), parse_mode=ParseMode.HTML)
 
 @dp.message(Command("menu"))
 async def show_menu(message: types.Message):
-    await message.answer("📱 Главное меню:", reply_markup=get_main_keyboard(is_admin(message.from_user.id)))
+    return message.answer("📱 Главное меню:", reply_markup=get_main_keyboard(is_admin(message.from_user.id)))
 
 @dp.message(Command("help"))
 async def help_command(message: types.Message):
@@ -160,383 +930,486 @@ async def help_command(message: types.Message):
             "Для администраторов:\n"
             "• 🛠️ Админ-панель - управление системой\n"
             "• ➕ Создать мероприятие - добавление нового мероприятия\n"
+            "• Файл CSV/JSON - массовое добавление мероприятий\n"
             "• 🗑️ Удалить мероприятие - удаление существующего\n"
             "• 👥 Участники - просмотр зарегистрированных\n"
-            "• 📤 Экспорт записей - выгрузка данных в CSV\n\n"
+            "• 📤 Экспорт записей - выгрузка данных в CSV\n"
+            "• 📦 Экспорт всех мероприятий - архив со всеми участниками и сводкой\n"
+            "• /broadcast all|ID_мероприятия текст - рассылка всем или участникам\n"
+            "• /stats - служебная статистика бота\n\n"
             "Все функции доступны через интерактивные меню!")
     
-    await message.answer(text, parse_mode=ParseMode.HTML)
+    return message.answer(text, parse_mode=ParseMode.HTML)
+
+@dp.message(Command("stats"))
+async def stats_command(message: types.Message, session: AsyncSession):
+    if not is_admin(message.from_user.id):
+        return message.answer("⛔ Доступ запрещен!", reply_markup=get_main_keyboard(False))
+    
+    text = ("📈 <b>Статистика</b>\n\n"
+            f"Пул БД: выдач {db_pool_stats['checkouts']}, "
+            f"ожидание {db_pool_stats['wait_seconds']:.3f} с, "
+            f"таймаутов {db_pool_stats['timeouts']}\n"
+            f"Кэш мероприятий: попаданий {upcoming_cache_stats['hits']}, "
+            f"промахов {upcoming_cache_stats['misses']}\n"
+            f"Кэш пользователей: попаданий {user_cache.hits}, промахов {user_cache.misses}, "
+            f"записей {len(user_cache.data)}\n"
+            f"Рассылки: запусков {fanout_stats['runs']}, отправлено {fanout_stats['sent']}, "
+            f"ошибок {fanout_stats['failed']}, повторов {fanout_stats['retries']}, "
+            f"последняя скорость {fanout_stats['last_rate']:.1f} сообщ./с")
+    
+    text += "\nЗапросы к API: " + ", ".join(
+        f"{name} {outbound_stats['requests'][p]} (ожидание {outbound_stats['wait_seconds'][p]:.1f} с, "
+        f"макс. {outbound_stats['max_wait'][p]:.2f} с)"
+        for p, name in enumerate(PRIORITY_NAMES)
+    ) + f", ответов 429: {outbound_stats['retry_after']}"
+    text += (f"\nОтветы в теле вебхука: {outbound_stats['webhook_replies']} "
+             f"(ожидание {outbound_stats['webhook_wait_seconds']:.1f} с, "
+             f"макс. {outbound_stats['webhook_max_wait']:.2f} с)")
+    
+    text += (f"\nАнтифлуд: пропущено {throttle_stats['passed']}, отброшено {throttle_stats['dropped']}, "
+             f"отслеживается {len(throttling.buckets)}")
+    
+    text += f"\nЭкспорт: из кэша {export_cache_stats['hits']}, сформировано {export_cache_stats['misses']}"
+    
+    processed = update_queue_stats["processed"]
+    text += (f"\nАпдейты: обработано {processed}, в работе {update_queue_stats['active']}, "
+             f"в очереди {update_queue_stats['waiting']} (макс. {update_queue_stats['max_waiting']}), "
+             f"отклонено {update_queue_stats['rejected']}, "
+             f"ожидание ср. {update_queue_stats['wait_seconds'] / max(processed, 1):.3f} с, "
+             f"макс. {update_queue_stats['max_wait']:.3f} с")
+    text += (f"\nВоркер: {leader_state['owner']}, "
+             f"{'лидер' if leader_state['is_leader'] else 'не лидер'}")
+    
+    outbox = (await session.execute(
+        select(OutboxMessage.status, func.count()).group_by(OutboxMessage.status)
+    )).all()
+    if outbox:
+        text += "\nОчередь: " + ", ".join(f"{status} {count}" for status, count in outbox)
+    
+    return message.answer(text, parse_mode=ParseMode.HTML)
+
+@dp.message(Command("broadcast"))
+async def broadcast_command(message: types.Message, session: AsyncSession):
+    if not is_admin(message.from_user.id):
+        return message.answer("⛔ Доступ запрещен!", reply_markup=get_main_keyboard(False))
+    
+    # html_text сохраняет форматирование и экранирует остальное для parse_mode=HTML
+    parts = message.html_text.split(maxsplit=2)
+    if len(parts) < 3 or not (parts[1] == "all" or parts[1].isdigit()):
+        return message.answer(
+            "📣 Формат: <code>/broadcast all текст</code> - всем пользователям\n"
+            "или <code>/broadcast ID текст</code> - участникам мероприятия",
+            parse_mode=ParseMode.HTML
+        )
+    
+    event_id = None if parts[1] == "all" else int(parts[1])
+    if event_id is not None and await session.get(Event, event_id) is None:
+        return message.answer("Мероприятие не найдено!")
+    
+    progress = await message.answer("📣 Рассылка готовится...")
+    broadcast = Broadcast(text=parts[2], event_id=event_id, chat_id=progress.chat.id, message_id=progress.message_id)
+    session.add(broadcast)
+    await session.flush()
+    
+    # Получатели выбираются и ставятся в очередь одним INSERT ... SELECT, без выгрузки в память
+    recipients = select(
+        literal(f"broadcast:{broadcast.id}:").concat(User.tg_id), User.tg_id, literal(broadcast.text), literal(broadcast.id)
+    ).where(User.tg_id.is_not(None))  # без WHERE SQLite не разбирает INSERT ... SELECT ... ON CONFLICT
+    if event_id is not None:
+        recipients = recipients.join(Registration.user).where(Registration.event_id == event_id)
+    result = await session.execute(
+        sqlite_insert(OutboxMessage)
+        .from_select([OutboxMessage.idempotency_key, OutboxMessage.chat_id, OutboxMessage.text, OutboxMessage.broadcast_id],
+                     recipients)
+        .on_conflict_do_nothing(index_elements=[OutboxMessage.idempotency_key])
+    )
+    broadcast.total = result.rowcount
+    await session.commit()
+    outbox_wakeup.set()
+    
+    _, text, markup = await broadcast_progress_view(session, broadcast)
+    return progress.edit_text(text, reply_markup=markup, parse_mode=ParseMode.HTML)
+
+@dp.callback_query(F.data.startswith("bcast:"))
+async def broadcast_control(callback: types.CallbackQuery, session: AsyncSession):
+    if not is_admin(callback.from_user.id):
+        return callback.answer("⛔ Доступ запрещен!")
+    
+    _, action, broadcast_id = callback.data.split(":")
+    broadcast = await session.get(Broadcast, int(broadcast_id))
+    if broadcast is None or broadcast.status == "done":
+        return callback.answer("Рассылка уже завершена")
+    
+    # Уже взятая в отправку пачка досылается, остальное ждет в статусе paused
+    if action == "pause":
+        statuses, broadcast.status = ("pending", "paused"), "paused"
+    else:
+        statuses, broadcast.status = ("paused", "pending"), "running"
+    await session.execute(
+        update(OutboxMessage)
+        .where(OutboxMessage.broadcast_id == broadcast.id, OutboxMessage.status == statuses[0])
+        .values(status=statuses[1])
+    )
+    await session.commit()
+    if broadcast.status == "running":
+        outbox_wakeup.set()
+    
+    _, text, markup = await broadcast_progress_view(session, broadcast)
+    broadcast_progress_text[broadcast.id] = text
+    return callback.message.edit_text(text, reply_markup=markup, parse_mode=ParseMode.HTML)
 
 # --- Обработчики кнопок --- #
 @dp.message(F.text == "📅 Предстоящие мероприятия")
-async def list_events(message: types.Message):
-    session = Session()
-    today = date.today()
-    events = session.query(Event).filter(Event.date >= today).order_by(Event.date).all()
-    
-    if not events:
-        await message.answer("📭 На данный момент нет доступных мероприятий.", reply_markup=get_main_keyboard(is_admin(message.from_user.id)))
-        return
+async def list_events(message: types.Message, session: AsyncSession):
+    text, markup = await get_upcoming_view(session)
     
-    text = "📅 <b>Предстоящие мероприятия:</b>\n\n"
-    for idx, event in enumerate(events, 1):
-        text += (f"{idx}. {format_event_short(event)}\n\n")
+    if text is None:
+        return message.answer("📭 На данный момент нет доступных мероприятий.", reply_markup=get_main_keyboard(is_admin(message.from_user.id)))
     
-    await message.answer(
+    return message.answer(
         text,
-        reply_markup=get_event_list_keyboard(events),
+        reply_markup=markup,
         parse_mode=ParseMode.HTML
     )
-    session.close()
 
 @dp.message(F.text == "🎫 Мои записи")
-async def my_events(message: types.Message):
-    session = Session()
-    user = session.query(User).filter_by(tg_id=message.from_user.id).first()
-    regs = session.query(Registration).filter_by(user_id=user.id).all()
+async def my_events(message: types.Message, session: AsyncSession):
+    user = await get_user_ref(session, message.from_user)
+    text, markup = await get_my_events_view(session, user.id)
     
-    if not regs:
+    if text is None:
         text = "📭 Вы пока не записаны ни на одно мероприятие."
-        await message.answer(text, reply_markup=get_main_keyboard(is_admin(message.from_user.id)))
-        return
-    
-    text = "🎫 <b>Ваши мероприятия:</b>\n\n"
-    for reg in regs:
-        text += format_registration(reg) + "\n\n"
-    
-    builder = InlineKeyboardBuilder()
-    for reg in regs:
-        builder.button(
-            text=f"❌ Отменить {reg.event.title}",
-            callback_data=f"cancel_{reg.id}"
-        )
-    builder.adjust(1)
+        return message.answer(text, reply_markup=get_main_keyboard(is_admin(message.from_user.id)))
     
-    await message.answer(
+    return message.answer(
         text,
-        reply_markup=builder.as_markup(),
+        reply_markup=markup,
         parse_mode=ParseMode.HTML
     )
-    session.close()
 
 @dp.message(F.text == "❌ Отменить запись")
-async def cancel_all_registrations(message: types.Message):
-    session = Session()
-    user = session.query(User).filter_by(tg_id=message.from_user.id).first()
-    regs = session.query(Registration).filter_by(user_id=user.id).all()
+async def cancel_all_registrations(message: types.Message, session: AsyncSession):
+    user = await get_user_ref(session, message.from_user)
+    deleted = await delete_user_registrations(session, user.id)
     
-    if not regs:
-        await message.answer("📭 У вас нет активных записей.", reply_markup=get_main_keyboard(is_admin(message.from_user.id)))
-        return
+    if not deleted:
+        return message.answer("📭 У вас нет активных записей.", reply_markup=get_main_keyboard(is_admin(message.from_user.id)))
     
-    for reg in regs:
-        session.delete(reg)
-    session.commit()
+    await session.commit()
     
-    await message.answer("✅ Все ваши записи отменены.", reply_markup=get_main_keyboard(is_admin(message.from_user.id)))
-    session.close()
+    return message.answer(f"✅ Все ваши записи отменены ({deleted}).", reply_markup=get_main_keyboard(is_admin(message.from_user.id)))
 
 @dp.message(F.text == "🛠️ Админ-панель")
 async def admin_panel(message: types.Message):
     if not is_admin(message.from_user.id):
-        await message.answer("⛔ Доступ запрещен!", reply_markup=get_main_keyboard(False))
-        return
+        return message.answer("⛔ Доступ запрещен!", reply_markup=get_main_keyboard(False))
     
     text = "🛠️ <b>Административная панель</b>\n\nВыберите действие:"
-    await message.answer(text, reply_markup=get_admin_keyboard(), parse_mode=ParseMode.HTML)
+    return message.answer(text, reply_markup=get_admin_keyboard(), parse_mode=ParseMode.HTML)
 
 @dp.message(F.text == "➕ Создать мероприятие")
 async def create_event_start(message: types.Message):
     if not is_admin(message.from_user.id):
-        await message.answer("⛔ Доступ запрещен!", reply_markup=get_main_keyboard(False))
-        return
+        return message.answer("⛔ Доступ запрещен!", reply_markup=get_main_keyboard(False))
     
     text = ("✏️ <b>Создание нового мероприятия</b>\n\n"
             "Введите данные в формате:\n"
             "<code>Название;Тема;Описание;ГГГГ-ММ-ДД</code>\n\n"
             "Пример:\n"
             "<code>Встреча разработчиков;IT;Обсуждение новых технологий;2024-12-15</code>\n\n"
+            "Чтобы добавить сразу много мероприятий, отправьте файл CSV с такими же колонками "
+            "или JSON - список объектов с полями title, topic, description, date\n\n"
             "Для отмены нажмите кнопку '🔙 Назад'")
     
-    await message.answer(text, reply_markup=get_back_keyboard(), parse_mode=ParseMode.HTML)
+    return message.answer(text, reply_markup=get_back_keyboard(), parse_mode=ParseMode.HTML)
 
 @dp.message(F.text == "📤 Экспорт записей")
-async def export_event_users(message: types.Message):
+async def export_event_users(message: types.Message, session: AsyncSession):
     if not is_admin(message.from_user.id):
-        await message.answer("⛔ Доступ запрещен!", reply_markup=get_main_keyboard(False))
-        return
-    
-    session = Session()
-    events = session.query(Event).all()
+        return message.answer("⛔ Доступ запрещен!", reply_markup=get_main_keyboard(False))
     
-    if not events:
-        await message.answer("📭 Нет мероприятий для экспорта", reply_markup=get_admin_keyboard())
-        return
+    text, markup = await get_event_picker_view(session, "expick")
+    if markup is None:
+        return message.answer(text, reply_markup=get_admin_keyboard())
     
-    text = "📤 <b>Экспорт участников</b>\n\nВыберите мероприятие:"
-    builder = InlineKeyboardBuilder()
-    for event in events:
-        builder.button(
-            text=f"{event.title} ({event.date.strftime('%d.%m.%Y')})",
-            callback_data=f"export_{event.id}"
-        )
-    builder.adjust(1)
+    return message.answer(text, reply_markup=markup, parse_mode=ParseMode.HTML)
+
+@dp.message(F.text == "📦 Экспорт всех мероприятий")
+async def export_all_events_handler(message: types.Message, session: AsyncSession):
+    if not is_admin(message.from_user.id):
+        return message.answer("⛔ Доступ запрещен!", reply_markup=get_main_keyboard(False))
     
-    await message.answer(text, reply_markup=builder.as_markup(), parse_mode=ParseMode.HTML)
-    session.close()
+    started = time.monotonic()
+    archive, size = await export_all_events(session)
+    try:
+        if not archive.summary:
+            return message.answer("📭 Нет мероприятий для экспорта", reply_markup=get_admin_keyboard())
+        if size > EXPORT_MAX_BYTES:
+            return message.answer(
+                f"⚠️ Архив занимает {size / 1024 / 1024:.1f} МБ - больше лимита Telegram. "
+                "Выгрузите мероприятия по отдельности через «📤 Экспорт записей».",
+                reply_markup=get_admin_keyboard()
+            )
+        
+        text = (f"📦 <b>Экспорт всех мероприятий</b>\n\n"
+                f"Мероприятий: {len(archive.summary)}\n"
+                f"Участников: {archive.participants}\n"
+                f"Сформировано за {time.monotonic() - started:.1f} с")
+        await send_documents(message, [SpooledInputFile(archive.file, f"events_{date.today().isoformat()}.zip")], text)
+    finally:
+        archive.file.close()
 
 @dp.message(F.text == "🗑️ Удалить мероприятие")
-async def delete_event_start(message: types.Message):
+async def delete_event_start(message: types.Message, session: AsyncSession):
     if not is_admin(message.from_user.id):
-        await message.answer("⛔ Доступ запрещен!", reply_markup=get_main_keyboard(False))
-        return
+        return message.answer("⛔ Доступ запрещен!", reply_markup=get_main_keyboard(False))
     
-    session = Session()
-    events = session.query(Event).order_by(Event.date).all()
+    text, markup = await get_event_picker_view(session, "delpick")
+    if markup is None:
+        return message.answer(text, reply_markup=get_admin_keyboard())
     
-    if not events:
-        await message.answer("📭 Нет мероприятий для удаления", reply_markup=get_admin_keyboard())
-        return
-    
-    text = "🗑️ <b>Удаление мероприятия</b>\n\nВыберите мероприятие:"
-    builder = InlineKeyboardBuilder()
-    for event in events:
-        builder.button(
-            text=f"{event.title} ({event.date.strftime('%d.%m.%Y')})",
-            callback_data=f"delete_{event.id}"
-        )
-    builder.adjust(1)
-    
-    await message.answer(text, reply_markup=builder.as_markup(), parse_mode=ParseMode.HTML)
-    session.close()
+    return message.answer(text, reply_markup=markup, parse_mode=ParseMode.HTML)
 
 @dp.message(F.text == "👥 Участники")
-async def show_users_start(message: types.Message):
+async def show_users_start(message: types.Message, session: AsyncSession):
     if not is_admin(message.from_user.id):
-        await message.answer("⛔ Доступ запрещен!", reply_markup=get_main_keyboard(False))
-        return
-    
-    session = Session()
-    events = session.query(Event).order_by(Event.date).all()
-    
-    if not events:
-        await message.answer("📭 Нет мероприятий", reply_markup=get_admin_keyboard())
-        return
+        return message.answer("⛔ Доступ запрещен!", reply_markup=get_main_keyboard(False))
     
-    text = "👥 <b>Просмотр участников</b>\n\nВыберите мероприятие:"
-    builder = InlineKeyboardBuilder()
-    for event in events:
-        builder.button(
-            text=f"{event.title} ({len(event.registrations)})",
-            callback_data=f"users_{event.id}"
-        )
-    builder.adjust(1)
+    text, markup = await get_event_picker_view(session, "uspick")
+    if markup is None:
+        return message.answer(text, reply_markup=get_admin_keyboard())
     
-    await message.answer(text, reply_markup=builder.as_markup(), parse_mode=ParseMode.HTML)
-    session.close()
+    return message.answer(text, reply_markup=markup, parse_mode=ParseMode.HTML)
 
 @dp.message(F.text == "🔙 Назад")
 async def back_handler(message: types.Message):
     if is_admin(message.from_user.id):
-        await message.answer("🔙 Возврат в админ-панель", reply_markup=get_admin_keyboard())
+        return message.answer("🔙 Возврат в админ-панель", reply_markup=get_admin_keyboard())
     else:
-        await message.answer("🔙 Возврат в главное меню", reply_markup=get_main_keyboard(False))
+        return message.answer("🔙 Возврат в главное меню", reply_markup=get_main_keyboard(False))
 
 @dp.message(F.text == "🔙 Главное меню")
 async def back_to_main_menu(message: types.Message):
-    await message.answer("🏠 Возврат в главное меню", reply_markup=get_main_keyboard(is_admin(message.from_user.id)))
+    return message.answer("🏠 Возврат в главное меню", reply_markup=get_main_keyboard(is_admin(message.from_user.id)))
 
 # --- Обработчики событий (новые для кнопки "Подробнее") --- #
 @dp.callback_query(F.data.startswith("event_select_"))
-async def event_select(callback: types.CallbackQuery):
+async def event_select(callback: types.CallbackQuery, session: AsyncSession):
     event_id = int(callback.data.split("_")[2])
-    session = Session()
-    event = session.query(Event).get(event_id)
-    user = session.query(User).filter_by(tg_id=callback.from_user.id).first()
+    event = await session.get(Event, event_id)
+    user = await get_user_ref(session, callback.from_user)
     
     if not event:
-        await callback.answer("Мероприятие не найдено!")
-        return
+        return callback.answer("Мероприятие не найдено!")
     
     # Проверяем, зарегистрирован ли пользователь
-    is_registered = session.query(Registration).filter_by(
+    is_registered = await session.scalar(select(Registration).filter_by(
         user_id=user.id, 
         event_id=event_id
-    ).first() is not None
+    )) is not None
     
     text = format_event_short(event)
-    session.close()
     
-    await callback.message.edit_text(
+    return callback.message.edit_text(
         text,
         reply_markup=get_event_details_keyboard(event_id, is_registered),
         parse_mode=ParseMode.HTML
     )
 
 @dp.callback_query(F.data.startswith("event_details_"))
-async def event_details(callback: types.CallbackQuery):
+async def event_details(callback: types.CallbackQuery, session: AsyncSession):
     event_id = int(callback.data.split("_")[2])
-    session = Session()
-    event = session.query(Event).get(event_id)
-    user = session.query(User).filter_by(tg_id=callback.from_user.id).first()
+    event = await session.get(Event, event_id)
+    user = await get_user_ref(session, callback.from_user)
     
     if not event:
-        await callback.answer("Мероприятие не найдено!")
-        return
+        return callback.answer("Мероприятие не найдено!")
     
     # Проверяем, зарегистрирован ли пользователь
-    is_registered = session.query(Registration).filter_by(
+    is_registered = await session.scalar(select(Registration).filter_by(
         user_id=user.id, 
         event_id=event_id
-    ).first() is not None
+    )) is not None
     
     text = format_event_full(event)
-    session.close()
     
-    await callback.message.edit_text(
+    return callback.message.edit_text(
         text,
         reply_markup=get_event_details_keyboard(event_id, is_registered),
         parse_mode=ParseMode.HTML
     )
 
 @dp.callback_query(F.data.startswith("event_register_"))
-async def register_callback(callback: types.CallbackQuery):
+async def register_callback(callback: types.CallbackQuery, session: AsyncSession):
     event_id = int(callback.data.split("_")[2])
-    session = Session()
+    user = await get_user_ref(session, callback.from_user)
     
-    try:
-        user = session.query(User).filter_by(tg_id=callback.from_user.id).first()
-        event = session.query(Event).get(event_id)
-        
-        if not event:
-            await callback.answer("Мероприятие не найдено!")
-            return
-        
-        existing = session.query(Registration).filter_by(user_id=user.id, event_id=event_id).first()
-        
-        if existing:
-            await callback.answer("⚠️ Вы уже записаны на это мероприятие!")
-            return
-        
-        reg = Registration(user_id=user.id, event_id=event_id)
-        session.add(reg)
-        session.commit()
-        
-        text = (f"✅ <b>Вы успешно записаны!</b>\n\n"
-                f"Мероприятие: <b>{event.title}</b>\n"
-                f"Дата: {event.date.strftime('%d.%m.%Y')}\n\n"
-                f"Запись №: <code>{reg.id}</code>")
-        
-        await callback.message.edit_text(
-            text,
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
-                InlineKeyboardButton(text="📅 Мои записи", callback_data="my_events"),
-                InlineKeyboardButton(text="📋 Все мероприятия", callback_data="back_to_events")
-            ]]),
-            parse_mode=ParseMode.HTML
+    # Одна атомарная вставка: повтор отсекает уникальный индекс (event_id, user_id),
+    # несуществующее мероприятие - INSERT ... SELECT из events
+    reg_id = await session.scalar(
+        sqlite_insert(Registration)
+        .from_select(
+            [Registration.user_id, Registration.event_id, Registration.registered_at],
+            select(literal(user.id), Event.id, literal(datetime.utcnow(), DateTime)).where(Event.id == event_id)
         )
-    finally:
-        session.close()
+        .on_conflict_do_nothing(index_elements=[Registration.event_id, Registration.user_id])
+        .returning(Registration.id)
+    )
+    
+    if reg_id is None:
+        if await session.get(Event, event_id) is None:
+            return callback.answer("Мероприятие не найдено!")
+        return callback.answer("⚠️ Вы уже записаны на это мероприятие!")
+    
+    event = (await session.execute(
+        change_registrations_count(event_id, 1).returning(Event.title, Event.date)
+    )).one()
+    await session.commit()
+    
+    text = (f"✅ <b>Вы успешно записаны!</b>\n\n"
+            f"Мероприятие: <b>{event.title}</b>\n"
+            f"Дата: {event.date.strftime('%d.%m.%Y')}\n\n"
+            f"Запись №: <code>{reg_id}</code>")
+    
+    return callback.message.edit_text(
+        text,
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
+            InlineKeyboardButton(text="📅 Мои записи", callback_data="my_events"),
+            InlineKeyboardButton(text="📋 Все мероприятия", callback_data="back_to_events")
+        ]]),
+        parse_mode=ParseMode.HTML
+    )
 
 @dp.callback_query(F.data == "back_to_events")
-async def back_to_events(callback: types.CallbackQuery):
-    session = Session()
-    today = date.today()
-    events = session.query(Event).filter(Event.date >= today).order_by(Event.date).all()
+async def back_to_events(callback: types.CallbackQuery, session: AsyncSession):
+    text, markup = await get_upcoming_view(session)
     
-    if not events:
-        await callback.message.edit_text("📭 На данный момент нет доступных мероприятий.")
-        return
+    if text is None:
+        return callback.message.edit_text("📭 На данный момент нет доступных мероприятий.")
+    
+    return callback.message.edit_text(
+        text,
+        reply_markup=markup,
+        parse_mode=ParseMode.HTML
+    )
+
+@dp.callback_query(F.data.startswith("evpage:"))
+async def events_page(callback: types.CallbackQuery, session: AsyncSession):
+    _, direction, day, event_id = callback.data.split(":")
+    text, markup = await get_upcoming_view(session, direction, (date.fromisoformat(day), int(event_id)))
     
-    text = "📅 <b>Предстоящие мероприятия:</b>\n\n"
-    for idx, event in enumerate(events, 1):
-        text += (f"{idx}. {format_event_short(event)}\n\n")
+    if text is None:
+        return callback.message.edit_text("📭 На данный момент нет доступных мероприятий.")
     
-    await callback.message.edit_text(
+    return callback.message.edit_text(
         text,
-        reply_markup=get_event_list_keyboard(events),
+        reply_markup=markup,
+        parse_mode=ParseMode.HTML
+    )
+
+@dp.callback_query((F.data == "my_events") | F.data.startswith("mypage:"))
+async def my_events_page(callback: types.CallbackQuery, session: AsyncSession):
+    user = await get_user_ref(session, callback.from_user)
+    if callback.data == "my_events":
+        text, markup = await get_my_events_view(session, user.id)
+    else:
+        _, direction, reg_id = callback.data.split(":")
+        text, markup = await get_my_events_view(session, user.id, direction, (int(reg_id),))
+    
+    if text is None:
+        return callback.message.edit_text("📭 Вы пока не записаны ни на одно мероприятие.")
+    
+    return callback.message.edit_text(
+        text,
+        reply_markup=markup,
         parse_mode=ParseMode.HTML
     )
-    session.close()
 
 # --- Остальные обработчики --- #
 @dp.callback_query(F.data.startswith("cancel_"))
-async def cancel_registration(callback: types.CallbackQuery):
+async def cancel_registration(callback: types.CallbackQuery, session: AsyncSession):
     reg_id = int(callback.data.split("_")[1])
-    session = Session()
+    reg = await session.get(Registration, reg_id, options=[joinedload(Registration.event)])
+    if not reg:
+        return callback.answer("Запись не найдена!")
     
-    try:
-        reg = session.query(Registration).get(reg_id)
-        if not reg:
-            await callback.answer("Запись не найдена!")
-            return
-        
-        if reg.user.tg_id != callback.from_user.id:
-            await callback.answer("Это не ваша запись!")
-            return
-        
-        event_title = reg.event.title
-        session.delete(reg)
-        session.commit()
-        
-        text = f"❌ Запись на мероприятие <b>{event_title}</b> отменена."
-        await callback.message.edit_text(
-            text,
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
-                InlineKeyboardButton(text="📅 Мои записи", callback_data="my_events")
-            ]]),
-            parse_mode=ParseMode.HTML
-        )
-    finally:
-        session.close()
+    user = await get_user_ref(session, callback.from_user)
+    if reg.user_id != user.id:
+        return callback.answer("Это не ваша запись!")
+    
+    event_title = reg.event.title
+    await session.delete(reg)
+    await session.execute(change_registrations_count(reg.event_id, -1))
+    await session.commit()
+    
+    text = f"❌ Запись на мероприятие <b>{event_title}</b> отменена."
+    return callback.message.edit_text(
+        text,
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
+            InlineKeyboardButton(text="📅 Мои записи", callback_data="my_events")
+        ]]),
+        parse_mode=ParseMode.HTML
+    )
 
 @dp.callback_query(F.data.startswith("export_"))
-async def perform_export(callback: types.CallbackQuery):
+async def perform_export(callback: types.CallbackQuery, session: AsyncSession):
     event_id = int(callback.data.split("_")[1])
-    session = Session()
-    event = session.query(Event).get(event_id)
+    event = await session.get(Event, event_id)
     
     if not event:
-        await callback.answer("Мероприятие не найдено!")
-        return
+        return callback.answer("Мероприятие не найдено!")
     
-    filename = f"participants_{event_id}.csv"
-    with open(filename, "w", newline="", encoding="utf-8") as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(["ID", "ФИО", "Дата регистрации"])
-        
-        for reg in event.registrations:
-            writer.writerow([
-                reg.user.tg_id,
-                reg.user.full_name,
-                reg.registered_at.strftime("%Y-%m-%d %H:%M")
-            ])
-    
-    text = f"📊 <b>Экспорт участников</b>\n\nМероприятие: <b>{event.title}</b>\nУчастников: {len(event.registrations)}"
-    await callback.message.answer_document(
-        types.FSInputFile(filename),
-        caption=text,
-        parse_mode=ParseMode.HTML
+    cached = await session.get(ExportCache, event_id)
+    if cached is not None and cached.registrations_version == event.registrations_version:
+        text = f"📊 <b>Экспорт участников</b>\n\nМероприятие: <b>{event.title}</b>\nУчастников: {cached.participants}"
+        try:
+            await send_documents(callback.message, cached.file_ids.split(), text)
+            export_cache_stats["hits"] += 1
+            return callback.answer()
+        except TelegramBadRequest as e:
+            print(f"Сохраненный экспорт мероприятия {event_id} недоступен: {e}")
+    
+    # Версия и строки читаются в одной транзакции, поэтому соответствуют друг другу
+    export_cache_stats["misses"] += 1
+    parts, count = await export_participants(session, event_id)
+    files = await package_export(parts, f"participants_{event_id}")
+    
+    text = f"📊 <b>Экспорт участников</b>\n\nМероприятие: <b>{event.title}</b>\nУчастников: {count}"
+    try:
+        sent = await send_documents(callback.message, [SpooledInputFile(file, name) for file, name in files], text)
+    finally:
+        for file, _ in files:
+            file.close()
+    
+    values = {
+        "registrations_version": event.registrations_version,
+        "participants": count,
+        "file_ids": " ".join(message.document.file_id for message in sent),
+        "created_at": datetime.utcnow()
+    }
+    await session.execute(
+        sqlite_insert(ExportCache).values(event_id=event_id, **values)
+        .on_conflict_do_update(index_elements=[ExportCache.event_id], set_=values)
     )
-    session.close()
+    await session.commit()
+    return callback.answer()
 
 @dp.callback_query(F.data.startswith("delete_"))
-async def confirm_delete(callback: types.CallbackQuery):
+async def confirm_delete(callback: types.CallbackQuery, session: AsyncSession):
     event_id = int(callback.data.split("_")[1])
-    session = Session()
-    event = session.query(Event).get(event_id)
+    event = await session.get(Event, event_id)
     
     if not event:
-        await callback.answer("Мероприятие не найдено!")
-        return
+        return callback.answer("Мероприятие не найдено!")
     
     text = (f"⚠️ <b>Подтвердите удаление</b>\n\n"
             f"Мероприятие: <b>{event.title}</b>\n"
             f"Дата: {event.date.strftime('%d.%m.%Y')}\n"
-            f"Участников: {len(event.registrations)}\n\n"
+            f"Участников: {event.registrations_count}\n\n"
             f"Это действие нельзя отменить!")
     
-    await callback.message.edit_text(
+    return callback.message.edit_text(
         text,
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="✅ Подтвердить удаление", callback_data=f"confirm_delete_{event_id}")],
@@ -544,78 +1417,78 @@ async def confirm_delete(callback: types.CallbackQuery):
         ),
         parse_mode=ParseMode.HTML
     )
-    session.close()
 
 @dp.callback_query(F.data.startswith("confirm_delete_"))
-async def perform_delete(callback: types.CallbackQuery):
+async def perform_delete(callback: types.CallbackQuery, session: AsyncSession):
     event_id = int(callback.data.split("_")[2])
-    session = Session()
-    event = session.query(Event).get(event_id)
-    
-    if event:
-        title = event.title
-        session.delete(event)
-        session.commit()
-        text = f"✅ Мероприятие <b>{title}</b> удалено!"
+    title, deleted_registrations = await delete_event_with_registrations(session, event_id)
+    
+    if title is not None:
+        await invalidate_shared_cache(session, "upcoming")
+        await asyncio.to_thread(unschedule_event_reminders, event_id)
+        text = (f"✅ Мероприятие <b>{title}</b> удалено!\n"
+                f"Отменено записей: {deleted_registrations}")
     else:
         text = "⚠️ Мероприятие не найдено"
     
-    await callback.message.edit_text(
+    return callback.message.edit_text(
         text,
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
             InlineKeyboardButton(text="🔙 В админ-панель", callback_data="admin_panel")
         ]]),
         parse_mode=ParseMode.HTML
     )
-    session.close()
 
 @dp.callback_query(F.data.startswith("users_"))
-async def show_event_users(callback: types.CallbackQuery):
+async def show_event_users(callback: types.CallbackQuery, session: AsyncSession):
     event_id = int(callback.data.split("_")[1])
-    session = Session()
-    event = session.query(Event).get(event_id)
+    event = await session.get(Event, event_id)
     
     if not event:
-        await callback.answer("Мероприятие не найдено!")
-        return
+        return callback.answer("Мероприятие не найдено!")
     
-    registrations = event.registrations
-    if not registrations:
-        text = f"📭 На мероприятие <b>{event.title}</b> пока никто не зарегистрировался."
-    else:
-        text = f"👥 <b>Участники мероприятия</b>\n\nМероприятие: <b>{event.title}</b>\n\n"
-        for reg in registrations:
-            text += f"• {reg.user.full_name} (ID: {reg.user.tg_id})\n"
+    text, markup = await get_participants_view(session, event)
+    return callback.message.edit_text(text, reply_markup=markup, parse_mode=ParseMode.HTML)
+
+@dp.callback_query(F.data.startswith("uspage:"))
+async def show_event_users_page(callback: types.CallbackQuery, session: AsyncSession):
+    _, event_id, direction, reg_id = callback.data.split(":")
+    event = await session.get(Event, int(event_id))
     
-    await callback.message.edit_text(
-        text,
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
-            InlineKeyboardButton(text="📤 Экспорт", callback_data=f"export_{event_id}"),
-            InlineKeyboardButton(text="🔙 Назад", callback_data="show_users")
-        ]]),
-        parse_mode=ParseMode.HTML
-    )
-    session.close()
+    if not event:
+        return callback.answer("Мероприятие не найдено!")
+    
+    text, markup = await get_participants_view(session, event, direction, (int(reg_id),))
+    return callback.message.edit_text(text, reply_markup=markup, parse_mode=ParseMode.HTML)
+
+@dp.callback_query((F.data == "show_users") | F.data.startswith(tuple(f"{picker}:" for picker in EVENT_PICKERS)))
+async def event_picker_page(callback: types.CallbackQuery, session: AsyncSession):
+    if not is_admin(callback.from_user.id):
+        return callback.answer("⛔ Доступ запрещен!")
+    
+    if callback.data == "show_users":
+        text, markup = await get_event_picker_view(session, "uspick")
+    else:
+        picker, direction, day, event_id = callback.data.split(":")
+        text, markup = await get_event_picker_view(session, picker, direction, (date.fromisoformat(day), int(event_id)))
+    return callback.message.edit_text(text, reply_markup=markup, parse_mode=ParseMode.HTML)
 
 # --- Обработка создания мероприятий --- #
 @dp.message(F.text.contains(';'))
-async def handle_event_creation(message: types.Message):
+async def handle_event_creation(message: types.Message, session: AsyncSession):
     if not is_admin(message.from_user.id):
         return
     
     parts = message.text.split(';')
     if len(parts) != 4:
-        await message.answer("⚠️ Неверный формат. Нужно 4 части, разделенные ';'", reply_markup=get_admin_keyboard())
-        return
+        return message.answer("⚠️ Неверный формат. Нужно 4 части, разделенные ';'", reply_markup=get_admin_keyboard())
     
     try:
         title, topic, description, raw_date = [part.strip() for part in parts]
         event_date = datetime.strptime(raw_date, "%Y-%m-%d").date()
     except ValueError:
-        await message.answer("⚠️ Ошибка в формате даты. Используйте ГГГГ-ММ-ДД", reply_markup=get_admin_keyboard())
-        return
+        return message.answer("⚠️ Ошибка в формате даты. Используйте ГГГГ-ММ-ДД", reply_markup=get_admin_keyboard())
     
-    session = Session()
     event = Event(
         title=title,
         topic=topic,
@@ -623,42 +1496,843 @@ async def handle_event_creation(message: types.Message):
         date=event_date
     )
     session.add(event)
-    session.commit()
+    await session.commit()
+    await invalidate_shared_cache(session, "upcoming")
+    await asyncio.to_thread(schedule_event_reminders, event.id, event_date)
     
     text = (f"✅ <b>Мероприятие создано!</b>\n\n"
             f"ID: <code>{event.id}</code>\n"
             f"Название: <b>{title}</b>\n"
             f"Дата: {event_date.strftime('%d.%m.%Y')}")
     
-    await message.answer(text, reply_markup=get_admin_keyboard(), parse_mode=ParseMode.HTML)
-    session.close()
+    return message.answer(text, reply_markup=get_admin_keyboard(), parse_mode=ParseMode.HTML)
 
-# --- Напоминания --- #
-async def notify_users():
-    session = Session()
-    tomorrow = date.today() + timedelta(days=1)
-    events = session.query(Event).filter_by(date=tomorrow).all()
+# --- Импорт мероприятий --- #
+IMPORT_FIELDS = ["title", "topic", "description", "date"]
+
+def parse_import_file(file, filename):
+    # Выполняется в потоке; CSV читается построчно, выдает пары (номер строки, значения)
+    text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+    if filename.lower().endswith(".json"):
+        items = json.load(text)
+        if not isinstance(items, list):
+            raise ValueError("ожидается список объектов")
+        for number, item in enumerate(items, 1):
+            yield number, [item.get(field) for field in IMPORT_FIELDS] if isinstance(item, dict) else None
+        return
     
-    for event in events:
-        for reg in event.registrations:
+    first_line = text.readline()
+    text.seek(0)
+    delimiter = ";" if first_line.count(";") >= first_line.count(",") else ","
+    for number, values in enumerate(csv.reader(text, delimiter=delimiter), 1):
+        if number == 1 and values and values[0].strip().lower() in ("название", "title"):
+            continue
+        if values:
+            yield number, values
+
+def validate_import_row(values):
+    # Те же правила, что и при создании мероприятия сообщением
+    if values is None or len(values) != 4:
+        return None, "нужно 4 поля: название, тема, описание, дата"
+    title, topic, description, raw_date = ["" if value is None else str(value).strip() for value in values]
+    if not title:
+        return None, "пустое название"
+    try:
+        event_date = datetime.strptime(raw_date, "%Y-%m-%d").date()
+    except ValueError:
+        # Значение из файла попадает в отчет, длинное обрезаем
+        if len(raw_date) > 30:
+            raw_date = raw_date[:30] + "…"
+        return None, f"дата «{raw_date}» не в формате ГГГГ-ММ-ДД"
+    return {"title": title, "topic": topic, "description": description, "date": event_date}, None
+
+def read_import_file(file, filename):
+    rows, errors = [], []
+    try:
+        for number, values in parse_import_file(file, filename):
+            row, error = validate_import_row(values)
+            if row is None:
+                errors.append((number, error))
+            else:
+                rows.append(row)
+    except (ValueError, UnicodeDecodeError, csv.Error, AttributeError) as e:
+        errors.append((0, f"файл не читается: {e}"))
+    return rows, errors
+
+async def import_events(session, rows):
+    # Пачки по IMPORT_BATCH одним executemany, коммит после каждой
+    created = []
+    for start in range(0, len(rows), IMPORT_BATCH):
+        result = await session.execute(
+            sqlite_insert(Event).returning(Event.id, Event.date),
+            rows[start:start + IMPORT_BATCH]
+        )
+        created.extend(result.all())
+        await session.commit()
+    return created
+
+@dp.message(F.document)
+async def import_events_document(message: types.Message, session: AsyncSession):
+    if not is_admin(message.from_user.id):
+        return
+    
+    document = message.document
+    filename = document.file_name or ""
+    if not filename.lower().endswith((".csv", ".json")):
+        return message.answer("⚠️ Для импорта мероприятий нужен файл .csv или .json", reply_markup=get_admin_keyboard())
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        return message.answer("⚠️ Файл слишком большой, разделите его на части", reply_markup=get_admin_keyboard())
+    
+    started = time.monotonic()
+    # Файл не больше IMPORT_MAX_BYTES, держим его в памяти
+    with io.BytesIO() as file:
+        await bot.download(document, destination=file)
+        rows, errors = await asyncio.to_thread(read_import_file, file, filename)
+    
+    if errors:
+        # Частичный импорт при повторной отправке файла дал бы дубли, поэтому не сохраняем ничего
+        text = (f"⚠️ <b>Импорт не выполнен</b>\n\n"
+                f"Ошибок: {len(errors)}, корректных строк: {len(rows)}\n\n")
+        if len(errors) <= IMPORT_REPORT_LINES:
+            # В ошибках встречаются значения из файла, а сообщение уходит с разметкой HTML
+            text += "\n".join(f"• строка {number}: {html.escape(error)}" if number else f"• {html.escape(error)}"
+                               for number, error in errors)
+            return message.answer(text, reply_markup=get_admin_keyboard(), parse_mode=ParseMode.HTML)
+        
+        # Подпись к документу ограничена 1024 символами, полный список - в файле
+        text += "Список ошибок - в файле import_errors.csv"
+        report = io.StringIO()
+        writer = csv.writer(report)
+        writer.writerow(["Строка", "Ошибка"])
+        writer.writerows(errors)
+        await send_documents(message, [BufferedInputFile(report.getvalue().encode("utf-8"), "import_errors.csv")], text)
+        return
+    
+    if not rows:
+        return message.answer("📭 В файле нет мероприятий", reply_markup=get_admin_keyboard())
+    
+    created = await import_events(session, rows)
+    # Кэш и напоминания обновляются один раз на весь файл; задачи пишутся в БД синхронно
+    await invalidate_shared_cache(session, "upcoming")
+    await asyncio.to_thread(schedule_reminders_for, created)
+    
+    text = (f"✅ <b>Импорт завершен</b>\n\n"
+            f"Добавлено мероприятий: {len(created)}\n"
+            f"Время: {time.monotonic() - started:.1f} с")
+    return message.answer(text, reply_markup=get_admin_keyboard(), parse_mode=ParseMode.HTML)
+
+# --- Ограничение исходящих запросов --- #
+# Классы приоритета: меньший номер обслуживается раньше
+PRIORITY_CALLBACK, PRIORITY_INTERACTIVE, PRIORITY_BULK = range(3)
+PRIORITY_NAMES = ("ответы на кнопки", "ответы", "рассылки")
+# Рассылка помечает свои запросы, чтобы они уступали ответам пользователям
+bulk_send = ContextVar("bulk_send", default=False)
+outbound_stats = {
+    "requests": [0, 0, 0],
+    "wait_seconds": [0.0, 0.0, 0.0],
+    "max_wait": [0.0, 0.0, 0.0],
+    "retry_after": 0,
+    # Ответы в теле вебхука: токены берутся до ответа Telegram, они входят и в счетчики выше
+    "webhook_replies": 0,
+    "webhook_wait_seconds": 0.0,
+    "webhook_max_wait": 0.0
+}
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.hold_until = 0.0
+        self.waiting = [0, 0, 0]
+
+    def hold(self, seconds):
+        # Пауза для всех ожидающих, например после TelegramRetryAfter
+        self.hold_until = max(self.hold_until, time.monotonic() + seconds)
+
+    def is_idle(self, now):
+        # Наполнившийся бакет ничем не отличается от нового
+        return (not any(self.waiting) and now >= self.hold_until
+                and now - self.updated >= self.capacity / self.rate)
+
+    async def acquire(self, priority=PRIORITY_CALLBACK):
+        # Пока ждут запросы с более высоким приоритетом, токены достаются им
+        self.waiting[priority] += 1
+        try:
+            while True:
+                now = time.monotonic()
+                if now < self.hold_until:
+                    await asyncio.sleep(self.hold_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1 and not any(self.waiting[:priority]):
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep(max((1 - self.tokens) / self.rate, 0.01))
+        finally:
+            self.waiting[priority] -= 1
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    # Общий и початовый лимиты для всех запросов бота к Bot API
+    def __init__(self, global_rate, bulk_rate, chat_rate, chat_burst, max_chats):
+        self.global_bucket = TokenBucket(global_rate)
+        self.bulk_bucket = TokenBucket(bulk_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_chats = max_chats
+        self.chat_buckets = {}
+
+    def get_chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= self.max_chats:
+                now = time.monotonic()
+                for idle in [key for key, b in self.chat_buckets.items() if b.is_idle(now)]:
+                    del self.chat_buckets[idle]
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, capacity=self.chat_burst)
+        return bucket
+
+    async def reserve(self, method):
+        # Ждет токены для запроса; возвращает (приоритет, бакет чата) или None, если запрос не ограничивается
+        chat_id = getattr(method, "chat_id", None)
+        if isinstance(method, AnswerCallbackQuery):
+            priority = PRIORITY_CALLBACK
+        elif chat_id is not None:
+            priority = PRIORITY_BULK if bulk_send.get() else PRIORITY_INTERACTIVE
+        else:
+            # getUpdates, getMe, setWebhook и т.п. не ограничиваем
+            return None
+        
+        started = time.monotonic()
+        chat_bucket = self.get_chat_bucket(chat_id) if chat_id is not None else None
+        if chat_bucket is not None:
+            await chat_bucket.acquire(priority)
+        if priority == PRIORITY_BULK:
+            # Рассылкам достается только часть общего лимита
+            await self.bulk_bucket.acquire()
+        await self.global_bucket.acquire(priority)
+        waited = time.monotonic() - started
+        outbound_stats["requests"][priority] += 1
+        outbound_stats["wait_seconds"][priority] += waited
+        outbound_stats["max_wait"][priority] = max(outbound_stats["max_wait"][priority], waited)
+        return priority, chat_bucket
+
+    async def __call__(self, make_request, bot, method):
+        reserved = await self.reserve(method)
+        if reserved is None:
+            return await make_request(bot, method)
+        priority, chat_bucket = reserved
+        
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            outbound_stats["retry_after"] += 1
+            if chat_bucket is not None:
+                chat_bucket.hold(e.retry_after)
+            if priority == PRIORITY_BULK:
+                self.bulk_bucket.hold(e.retry_after)
+            raise
+
+rate_limiter = RateLimitMiddleware(
+    BOT_API_GLOBAL_RATE, FANOUT_GLOBAL_RATE, BOT_API_PER_CHAT_RATE, BOT_API_CHAT_BURST, BOT_API_MAX_CHATS
+)
+bot.session.middleware(rate_limiter)
+
+async def reserve_webhook_reply(method):
+    # Ответ в теле вебхука минует сессию бота, поэтому лимиты для него соблюдаем заранее
+    started = time.monotonic()
+    if await rate_limiter.reserve(method) is None:
+        return
+    waited = time.monotonic() - started
+    outbound_stats["webhook_replies"] += 1
+    outbound_stats["webhook_wait_seconds"] += waited
+    outbound_stats["webhook_max_wait"] = max(outbound_stats["webhook_max_wait"], waited)
+
+# --- Экспорт --- #
+PARTICIPANTS_HEADER = ["ID", "ФИО", "Дата регистрации"]
+export_cache_stats = {"hits": 0, "misses": 0}
+
+class SpooledInputFile(InputFile):
+    # Загрузка из SpooledTemporaryFile: файл не получает общего имени на диске
+    def __init__(self, file, filename):
+        super().__init__(filename=filename)
+        self.file = file
+
+    async def read(self, bot):
+        await asyncio.to_thread(self.file.seek, 0)
+        while chunk := await asyncio.to_thread(self.file.read, self.chunk_size):
+            yield chunk
+
+def encode_csv(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue().encode("utf-8")
+
+def new_export_part(header):
+    part = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+    part.write(encode_csv([header]))
+    return part
+
+async def write_export_rows(parts, rows, header):
+    # Кодирование и запись - в потоке; каждая часть - самостоятельный CSV не больше EXPORT_MAX_BYTES
+    data = await asyncio.to_thread(encode_csv, rows)
+    if not parts or parts[-1].tell() + len(data) > EXPORT_MAX_BYTES:
+        parts.append(new_export_part(header))
+    await asyncio.to_thread(parts[-1].write, data)
+
+async def export_participants(session, event_id):
+    # Строки читаются курсором по EXPORT_CHUNK_ROWS, в памяти не бывает всего списка
+    parts = []
+    count = 0
+    result = await session.stream(
+        event_participants_query(event_id).execution_options(yield_per=EXPORT_CHUNK_ROWS)
+    )
+    async for chunk in result.partitions():
+        await write_export_rows(parts, [
+            (tg_id, full_name, registered_at.strftime("%Y-%m-%d %H:%M"))
+            for tg_id, full_name, registered_at in chunk
+        ], PARTICIPANTS_HEADER)
+        count += len(chunk)
+    return parts or [new_export_part(PARTICIPANTS_HEADER)], count
+
+class EventsArchive:
+    # Zip с CSV на каждое мероприятие и сводкой; методы выполняются в потоке
+    def __init__(self):
+        self.file = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+        self.zip = zipfile.ZipFile(self.file, "w", zipfile.ZIP_DEFLATED)
+        self.member = None
+        self.writer = None
+        self.event_id = None
+        self.summary = []
+        self.participants = 0
+
+    def close_member(self):
+        if self.member is not None:
+            self.member.close()
+            self.member = None
+
+    def write(self, rows):
+        # Строки упорядочены по мероприятию, поэтому открыт всегда только один файл архива
+        for event_id, title, topic, event_date, tg_id, full_name, registered_at in rows:
+            if event_id != self.event_id:
+                self.close_member()
+                self.event_id = event_id
+                self.summary.append([event_id, title, topic, event_date.strftime("%Y-%m-%d"), 0])
+                self.member = io.TextIOWrapper(
+                    self.zip.open(f"{event_date.strftime('%Y-%m-%d')}_{event_id}.csv", "w", force_zip64=True),
+                    encoding="utf-8", newline=""
+                )
+                self.writer = csv.writer(self.member)
+                self.writer.writerow(PARTICIPANTS_HEADER)
+            if tg_id is not None:
+                self.writer.writerow([tg_id, full_name, registered_at.strftime("%Y-%m-%d %H:%M")])
+                self.summary[-1][-1] += 1
+                self.participants += 1
+
+    def finish(self):
+        self.close_member()
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(["ID", "Название", "Тема", "Дата", "Участников"])
+        writer.writerows(self.summary)
+        self.zip.writestr("summary.csv", buffer.getvalue().encode("utf-8"))
+        self.zip.close()
+        return self.file.tell()
+
+async def export_all_events(session):
+    # Все мероприятия с участниками одним JOIN; мероприятия без записей тоже попадают в архив
+    archive = EventsArchive()
+    result = await session.stream(
+        select(Event.id, Event.title, Event.topic, Event.date,
+               User.tg_id, User.full_name, Registration.registered_at)
+        .outerjoin(Registration, Registration.event_id == Event.id)
+        .outerjoin(User, User.id == Registration.user_id)
+        .order_by(Event.date, Event.id, Registration.id)
+        .execution_options(yield_per=EXPORT_CHUNK_ROWS)
+    )
+    try:
+        async for chunk in result.partitions():
+            await asyncio.to_thread(archive.write, chunk)
+        size = await asyncio.to_thread(archive.finish)
+    except BaseException:
+        archive.file.close()
+        raise
+    return archive, size
+
+def zip_files(files):
+    archive = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as zf:
+        for file, name in files:
+            file.seek(0)
+            with zf.open(name, "w", force_zip64=True) as target:
+                shutil.copyfileobj(file, target)
+    return archive
+
+async def package_export(parts, basename):
+    # Одна часть уходит как есть; несколько - одним zip, если он влезает в лимит, иначе по отдельности
+    if len(parts) == 1:
+        return [(parts[0], f"{basename}.csv")]
+    
+    files = [(part, f"{basename}_{number}.csv") for number, part in enumerate(parts, 1)]
+    archive = await asyncio.to_thread(zip_files, files)
+    if archive.tell() > EXPORT_MAX_BYTES:
+        archive.close()
+        return files
+    for part in parts:
+        part.close()
+    return [(archive, f"{basename}.zip")]
+
+async def send_documents(message, documents, caption):
+    # documents - InputFile или file_id ранее загруженных файлов; подпись у первого документа
+    sent = []
+    for number, document in enumerate(documents):
+        sent.append(await message.answer_document(
+            document,
+            caption=caption if number == 0 else None,
+            parse_mode=ParseMode.HTML
+        ))
+    return sent
+
+# --- Массовая рассылка --- #
+fanout_stats = {"runs": 0, "sent": 0, "failed": 0, "retries": 0, "last_rate": 0.0}
+
+# permanent - повтор ничего не изменит: бот заблокирован, чат не найден и т.п.
+DeliveryError = namedtuple("DeliveryError", ["text", "permanent"])
+
+async def deliver_message(chat_id, text, stats):
+    # Возвращает None при успехе или DeliveryError; темп отправки задает RateLimitMiddleware
+    error = DeliveryError("retry limit exceeded", False)
+    for _ in range(FANOUT_MAX_RETRIES + 1):
+        try:
+            await bot.send_message(chat_id, text, parse_mode=ParseMode.HTML)
+            stats["sent"] += 1
+            return None
+        except TelegramRetryAfter:
+            stats["retries"] += 1
+        except Exception as e:
+            print(f"Ошибка отправки сообщения {chat_id}: {e}")
+            permanent = isinstance(e, (TelegramForbiddenError, TelegramBadRequest))
+            error = DeliveryError(f"{e.__class__.__name__}: {e}", permanent)
+            break
+    stats["failed"] += 1
+    return error
+
+async def fan_out(messages, on_result=None):
+    # messages - итерируемое из троек (key, chat_id, text); его разбирают FANOUT_CONCURRENCY воркеров.
+    # on_result(key, error) вызывается после каждой доставки
+    stats = {"sent": 0, "failed": 0, "retries": 0}
+    pending = iter(messages)
+    started = time.monotonic()
+    
+    async def worker():
+        # Каждый воркер - отдельная задача со своей копией контекста
+        bulk_send.set(True)
+        for key, chat_id, text in pending:
+            error = await deliver_message(chat_id, text, stats)
+            if on_result is not None:
+                await on_result(key, error)
+    
+    await asyncio.gather(*(worker() for _ in range(FANOUT_CONCURRENCY)))
+    
+    elapsed = time.monotonic() - started
+    stats["rate"] = stats["sent"] / elapsed if elapsed else 0.0
+    fanout_stats["runs"] += 1
+    fanout_stats["last_rate"] = stats["rate"]
+    for key in ("sent", "failed", "retries"):
+        fanout_stats[key] += stats[key]
+    print(f"Рассылка завершена за {elapsed:.1f} с: отправлено {stats['sent']}, "
+          f"ошибок {stats['failed']}, повторов {stats['retries']}, {stats['rate']:.1f} сообщ./с")
+    return stats
+
+# --- Очередь исходящих сообщений --- #
+outbox_wakeup = asyncio.Event()
+
+async def enqueue_messages(session, messages):
+    # messages - словари с idempotency_key, chat_id и text; повторы по ключу пропускаются
+    if not messages:
+        return
+    await session.execute(
+        sqlite_insert(OutboxMessage).on_conflict_do_nothing(index_elements=[OutboxMessage.idempotency_key]),
+        messages
+    )
+    outbox_wakeup.set()
+
+def outbox_retry_status():
+    # Недоставленное сообщение приостановленной рассылки ждет продолжения, а не уходит снова
+    paused = select(Broadcast.id).where(
+        Broadcast.id == OutboxMessage.broadcast_id, Broadcast.status == "paused"
+    ).exists()
+    return case((paused, "paused"), else_="pending")
+
+async def save_outbox_results(results, attempts):
+    # results - пары (id, ошибка); все статусы пишутся одной транзакцией, чтобы реже занимать запись в SQLite
+    now = datetime.utcnow()
+    sent = [message_id for message_id, error in results if error is None]
+    failed = [{"message_id": message_id, "error": error.text}
+              for message_id, error in results if error is not None and error.permanent]
+    # Временные ошибки повторяем с нарастающей паузой
+    retried = [{"message_id": message_id, "error": error.text,
+                "retry_at": now + timedelta(seconds=OUTBOX_RETRY_SECONDS * 2 ** (attempts[message_id] - 1))}
+               for message_id, error in results if error is not None and not error.permanent]
+    
+    async with Session() as session:
+        if sent:
+            await session.execute(
+                update(OutboxMessage).where(OutboxMessage.id.in_(sent))
+                .values(status="sent", sent_at=now, last_error=None)
+            )
+        if failed:
+            await session.execute(
+                update(OutboxMessage.__table__).where(OutboxMessage.id == bindparam("message_id"))
+                .values(status="failed", last_error=bindparam("error")),
+                failed
+            )
+        if retried:
+            await session.execute(
+                update(OutboxMessage.__table__).where(OutboxMessage.id == bindparam("message_id"))
+                .values(
+                    status=case((OutboxMessage.attempts >= OUTBOX_MAX_ATTEMPTS, "failed"), else_=outbox_retry_status()),
+                    last_error=bindparam("error"),
+                    not_before=bindparam("retry_at")
+                ),
+                retried
+            )
+        await session.commit()
+
+async def drain_outbox():
+    async with Session() as session:
+        # Напоминания идут раньше рассылок администратора, рассылки добирают остаток пачки
+        batch = []
+        for source in (OutboxMessage.broadcast_id.is_(None), OutboxMessage.broadcast_id.is_not(None)):
+            batch += (await session.execute(
+                select(OutboxMessage.id, OutboxMessage.chat_id, OutboxMessage.text, OutboxMessage.attempts)
+                .where(OutboxMessage.status == "pending")
+                .where(source)
+                .where(or_(OutboxMessage.not_before.is_(None), OutboxMessage.not_before <= datetime.utcnow()))
+                .order_by(OutboxMessage.id)
+                .limit(OUTBOX_BATCH - len(batch))
+            )).all()
+            if len(batch) >= OUTBOX_BATCH:
+                break
+        if not batch:
+            return 0
+        await session.execute(
+            update(OutboxMessage)
+            .where(OutboxMessage.id.in_([row.id for row in batch]))
+            .values(status="sending", attempts=OutboxMessage.attempts + 1)
+        )
+        await session.commit()
+    
+    attempts = {row.id: row.attempts + 1 for row in batch}
+    results = []
+    
+    async def collect(message_id, error):
+        results.append((message_id, error))
+        if len(results) >= OUTBOX_RESULTS_BATCH:
+            ready = results[:]
+            results.clear()
+            await save_outbox_results(ready, attempts)
+    
+    await fan_out([(row.id, row.chat_id, row.text) for row in batch], on_result=collect)
+    if results:
+        await save_outbox_results(results, attempts)
+    return len(batch)
+
+async def outbox_worker():
+    # После перезапуска недоставленная пачка возвращается в очередь
+    async with Session() as session:
+        await session.execute(
+            update(OutboxMessage).where(OutboxMessage.status == "sending").values(status=outbox_retry_status())
+        )
+        await session.commit()
+    
+    while True:
+        try:
+            if await drain_outbox():
+                continue
+        except Exception as e:
+            print(f"Ошибка обработки очереди сообщений: {e}")
+        outbox_wakeup.clear()
+        try:
+            await asyncio.wait_for(outbox_wakeup.wait(), OUTBOX_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+# --- Рассылки администратора --- #
+BROADCAST_STATUSES = {"running": "идет", "paused": "на паузе", "done": "завершена"}
+# Последний показанный текст прогресса: Telegram отвергает правку без изменений
+broadcast_progress_text = {}
+
+async def broadcast_progress_view(session, broadcast):
+    counts = dict((await session.execute(
+        select(OutboxMessage.status, func.count())
+        .where(OutboxMessage.broadcast_id == broadcast.id)
+        .group_by(OutboxMessage.status)
+    )).all())
+    if broadcast.event_id is None:
+        audience = "всем пользователям"
+    else:
+        audience = f"участникам мероприятия ID {broadcast.event_id}"
+    text = (f"📣 <b>Рассылка #{broadcast.id}</b> {audience}\n\n"
+            f"Отправлено: {counts.get('sent', 0)} из {broadcast.total}\n"
+            f"Ошибок: {counts.get('failed', 0)}\n"
+            f"В очереди: {counts.get('pending', 0) + counts.get('sending', 0) + counts.get('paused', 0)}\n"
+            f"Статус: {BROADCAST_STATUSES[broadcast.status]}")
+    
+    if broadcast.status == "running":
+        button = InlineKeyboardButton(text="⏸ Пауза", callback_data=f"bcast:pause:{broadcast.id}")
+    elif broadcast.status == "paused":
+        button = InlineKeyboardButton(text="▶️ Продолжить", callback_data=f"bcast:resume:{broadcast.id}")
+    else:
+        return counts, text, None
+    return counts, text, InlineKeyboardMarkup(inline_keyboard=[[button]])
+
+async def report_broadcasts():
+    async with Session() as session:
+        broadcasts = (await session.scalars(
+            select(Broadcast).where(Broadcast.status.in_(("running", "paused")))
+        )).all()
+        for broadcast in broadcasts:
+            counts, text, markup = await broadcast_progress_view(session, broadcast)
+            if broadcast.status == "running" and not any(counts.get(s) for s in ("pending", "sending", "paused")):
+                broadcast.status = "done"
+                broadcast.finished_at = datetime.utcnow()
+                await session.commit()
+                counts, text, markup = await broadcast_progress_view(session, broadcast)
+            
+            if broadcast_progress_text.get(broadcast.id) == text:
+                continue
             try:
-                await bot.send_message(
-                    reg.user.tg_id,
-                    f"🔔 <b>Напоминание о мероприятии</b>\n\n"
-                    f"Завтра состоится: <b>{event.title}</b>\n"
-                    f"Дата: {event.date.strftime('%d.%m.%Y')}\n\n"
-                    f"Не забудьте прийти!",
-                    parse_mode=ParseMode.HTML
+                await bot.edit_message_text(
+                    text, chat_id=broadcast.chat_id, message_id=broadcast.message_id,
+                    reply_markup=markup, parse_mode=ParseMode.HTML
                 )
+            except TelegramBadRequest as e:
+                print(f"Не удалось обновить прогресс рассылки {broadcast.id}: {e}")
+            broadcast_progress_text[broadcast.id] = text
+            if broadcast.status == "done":
+                broadcast_progress_text.pop(broadcast.id)
+
+async def broadcast_progress_worker():
+    while True:
+        try:
+            await report_broadcasts()
+        except Exception as e:
+            print(f"Ошибка обновления прогресса рассылок: {e}")
+        await asyncio.sleep(BROADCAST_PROGRESS_SECONDS)
+
+# --- Напоминания --- #
+OFFSET_UNITS = {"d": ("days", "дн."), "h": ("hours", "ч."), "m": ("minutes", "мин.")}
+
+def parse_offset(label):
+    return timedelta(**{OFFSET_UNITS[label[-1]][0]: int(label[:-1])})
+
+def describe_offset(label):
+    if label == "1d":
+        return "Завтра состоится"
+    return f"Через {label[:-1]} {OFFSET_UNITS[label[-1]][1]} состоится"
+
+def schedule_event_reminders(event_id, event_date, skip=()):
+    # Хранилище задач коммитит в SQLite синхронно, поэтому вызывается через asyncio.to_thread
+    starts_at = datetime.combine(event_date, EVENT_START_TIME)
+    for label in REMINDER_OFFSETS:
+        job_id = f"reminder_{event_id}_{label}"
+        run_at = starts_at - parse_offset(label)
+        if run_at <= datetime.now() or job_id in skip:
+            continue
+        scheduler.add_job(
+            send_event_reminders, 'date', run_date=run_at, args=[event_id, label],
+            id=job_id, jobstore="reminders", replace_existing=True,
+            misfire_grace_time=REMINDER_MISFIRE_GRACE
+        )
+
+def unschedule_event_reminders(event_id):
+    for label in REMINDER_OFFSETS:
+        try:
+            scheduler.remove_job(f"reminder_{event_id}_{label}", jobstore="reminders")
+        except JobLookupError:
+            pass
+
+async def schedule_upcoming_reminders():
+    # Досоздаем только недостающие задачи (мероприятия, заведенные до появления хранилища задач);
+    # перезапись всех при каждой смене лидера надолго заняла бы БД
+    async with Session() as session:
+        events = (await session.execute(
+            select(Event.id, Event.date).where(Event.date >= date.today())
+        )).all()
+        existing = set(await session.scalars(select(reminder_jobstore.jobs_t.c.id)))
+    await asyncio.to_thread(schedule_reminders_for, events, existing)
+
+def schedule_reminders_for(events, skip=()):
+    # events - пары (id, дата), skip - id уже созданных задач
+    for event_id, event_date in events:
+        schedule_event_reminders(event_id, event_date, skip)
+
+async def send_event_reminders(event_id, label):
+    async with Session() as session:
+        recipients = (await session.execute(
+            select(User.tg_id, Event.title, Event.date)
+            .join(Registration.user)
+            .join(Registration.event)
+            .where(Event.id == event_id)
+        )).all()
+        
+        # Отправку большого мероприятия растягиваем на окно со случайным сдвигом
+        now = datetime.utcnow()
+        spread = REMINDER_SPREAD_SECONDS if len(recipients) > FANOUT_GLOBAL_RATE else 0
+        await enqueue_messages(session, [
+            {"idempotency_key": f"reminder:{event_id}:{label}:{tg_id}",
+             "chat_id": tg_id,
+             "not_before": now + timedelta(seconds=random.uniform(0, spread)),
+             "text": f"🔔 <b>Напоминание о мероприятии</b>\n\n"
+                     f"{describe_offset(label)}: <b>{title}</b>\n"
+                     f"Дата: {event_date.strftime('%d.%m.%Y')}\n\n"
+                     f"Не забудьте прийти!"}
+            for tg_id, title, event_date in recipients
+        ])
+        await session.commit()
+
+# --- Лидерство --- #
+leader_state = {"owner": None, "is_leader": False, "outbox_task": None, "progress_task": None}
+
+async def try_acquire_leadership(owner):
+    now = datetime.utcnow()
+    async with Session() as session:
+        statement = sqlite_insert(LeaderLock).values(
+            name="scheduler", owner=owner, expires_at=now + timedelta(seconds=LEADER_TTL_SECONDS)
+        )
+        await session.execute(statement.on_conflict_do_update(
+            index_elements=[LeaderLock.name],
+            set_={"owner": statement.excluded.owner, "expires_at": statement.excluded.expires_at},
+            where=or_(LeaderLock.owner == owner, LeaderLock.expires_at < now)
+        ))
+        await session.commit()
+        return await session.scalar(select(LeaderLock.owner).where(LeaderLock.name == "scheduler")) == owner
+
+async def become_leader():
+    # Сначала то, что может упасть: задачи лидера запускаются, только когда все готово
+    if BOT_MODE == "webhook":
+        await bot.set_webhook(
+            WEBHOOK_BASE_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+    await schedule_upcoming_reminders()
+    scheduler.resume()
+    leader_state["outbox_task"] = asyncio.create_task(outbox_worker())
+    leader_state["progress_task"] = asyncio.create_task(broadcast_progress_worker())
+    print(f"Воркер {leader_state['owner']} стал лидером")
+
+def step_down():
+    print(f"Воркер {leader_state['owner']} больше не лидер")
+    scheduler.pause()
+    for task in ("outbox_task", "progress_task"):
+        if leader_state[task] is not None:
+            leader_state[task].cancel()
+            leader_state[task] = None
+
+async def leadership_loop():
+    leader_state["owner"] = f"{socket.gethostname()}:{os.getpid()}"
+    while True:
+        try:
+            is_leader = await try_acquire_leadership(leader_state["owner"])
+        except Exception as e:
+            print(f"Ошибка продления лидерства: {e}")
+            is_leader = False
+        
+        if is_leader and not leader_state["is_leader"]:
+            try:
+                await become_leader()
+                leader_state["is_leader"] = True
             except Exception as e:
-                print(f"Ошибка отправки напоминания: {e}")
-    session.close()
+                # Аренда остается за нами, попытка повторится на следующем продлении
+                print(f"Ошибка перехода в лидеры: {e}")
+                step_down()
+        elif not is_leader and leader_state["is_leader"]:
+            leader_state["is_leader"] = False
+            step_down()
+        
+        if leader_state["is_leader"]:
+            # Задачи напоминаний могли добавить другие воркеры
+            scheduler.wakeup()
+        await asyncio.sleep(LEADER_RENEW_SECONDS)
 
 # --- Запуск --- #
+async def run_polling():
+    # getUpdates не работает, пока у бота установлен вебхук
+    await bot.delete_webhook()
+    # Лимит задач не дает очереди переполниться: лишние апдейты остаются на стороне Telegram
+    await dp.start_polling(bot, tasks_concurrency_limit=UPDATE_WORKERS + UPDATE_QUEUE_SIZE)
+
+class CachedMarkupRequestHandler(SimpleRequestHandler):
+    # Ответ в теле вебхука тоже получает готовый JSON клавиатуры
+    def _build_response_writer(self, bot, result):
+        if not result:
+            return super()._build_response_writer(bot, result)
+        result, payload = detach_cached_markup(result)
+        writer = super()._build_response_writer(bot, result)
+        if payload is not None:
+            writer.append(payload).set_content_disposition("form-data", name="reply_markup")
+        return writer
+
+async def run_webhook():
+    # Ответ обработчика (метод Bot API) уходит прямо в теле HTTP-ответа Telegram
+    app = web.Application()
+    CachedMarkupRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        handle_in_background=False,
+        secret_token=WEBHOOK_SECRET or None
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    
+    runner = web.AppRunner(app)
+    await runner.setup()
+    # reuse_port позволяет нескольким воркерам слушать один порт
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT, reuse_port=WORKERS > 1).start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
 async def main():
-    scheduler.add_job(notify_users, 'cron', hour=9, minute=0)
-    scheduler.start()
-    await dp.start_polling(bot)
+    await init_db()
+    scheduler.add_job(sqlite_maintenance, 'interval', minutes=SQLITE_MAINTENANCE_MINUTES)
+    # В полночь прошедшие мероприятия должны исчезнуть из списка
+    scheduler.add_job(rollover_upcoming_cache, 'cron', hour=0, minute=0)
+    # Задачи выполняет только лидер, но добавлять их в общее хранилище может любой воркер
+    scheduler.start(paused=True)
+    background_tasks = [asyncio.create_task(leadership_loop())]
+    if WORKERS > 1:
+        background_tasks.append(asyncio.create_task(sync_cache_versions()))
+    
+    if BOT_MODE == "webhook":
+        await run_webhook()
+    else:
+        await run_polling()
 
-if __name__ == "__main__":
+async def prepare_database():
+    await init_db()
+    await engine.dispose()
+
+def run_worker():
     asyncio.run(main())
+
+if __name__ == "__main__":
+    if BOT_MODE == "webhook" and not (WEBHOOK_BASE_URL.startswith("https://") and WEBHOOK_SECRET):
+        # Без адреса вебхук не зарегистрировать, без секрета обработчик примет запрос от кого угодно
+        raise SystemExit("Для режима webhook нужны WEBHOOK_BASE_URL (https://...) и WEBHOOK_SECRET")
+    if WORKERS > 1 and BOT_MODE == "webhook":
+        # Миграции один раз в родителе, затем воркеры делят порт и events.db
+        asyncio.run(prepare_database())
+        workers = [multiprocessing.Process(target=run_worker, name=f"worker-{n}") for n in range(WORKERS)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    else:
+        if WORKERS > 1:
+            print("Несколько воркеров поддерживаются только в режиме webhook, запускаем один")
+        asyncio.run(main())
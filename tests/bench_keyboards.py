@@ -0,0 +1,39 @@
+# Сколько стоит сборка формы sendMessage с клавиатурой: новая клавиатура против реестра.
+# Запуск: python tests/bench_keyboards.py
+import tempfile
+import timeit
+
+import pytest
+from aiogram import methods
+from aiogram.client.session.aiohttp import AiohttpSession
+
+from conftest import import_main
+
+NUMBER = 5000
+
+
+def send_message(markup):
+    return methods.SendMessage(chat_id=1, text="Привет", reply_markup=markup)
+
+
+def bench(main):
+    session, plain = main.bot.session, AiohttpSession()
+    cases = [
+        ("главная: новая + сериализация",
+         lambda: plain.build_form_data(main.bot, send_message(main.get_main_keyboard.__wrapped__(True)))),
+        ("главная: из реестра",
+         lambda: session.build_form_data(main.bot, send_message(main.get_main_keyboard(True)))),
+        ("мероприятие: новая + сериализация",
+         lambda: plain.build_form_data(main.bot, send_message(main.get_event_details_keyboard.__wrapped__(5, False)))),
+        ("мероприятие: из реестра",
+         lambda: session.build_form_data(main.bot, send_message(main.get_event_details_keyboard(5, False)))),
+        ("без клавиатуры",
+         lambda: session.build_form_data(main.bot, send_message(None))),
+    ]
+    for name, case in cases:
+        print(f"{name:36s} {timeit.timeit(case, number=NUMBER) / NUMBER * 1e6:8.1f} мкс")
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as workdir, pytest.MonkeyPatch.context() as mp:
+        bench(import_main(mp, workdir))
@@ -0,0 +1,17 @@
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def import_main(mp, workdir, admin_id=1):
+    # main.py при импорте создает Bot и открывает events.db в текущем каталоге
+    mp.chdir(workdir)
+    mp.setenv("ADMIN_IDS", str(admin_id))
+    mp.syspath_prepend(str(ROOT))
+    # Токен в main.py пустой: импорт проходит без проверки, дальше работает бот с тестовым токеном
+    mp.setattr("aiogram.client.bot.validate_token", lambda token: None)
+    sys.modules.pop("main", None)
+    import main
+    mp.setattr(main, "bot", main.Bot(token="42:TEST", session=main.CachedMarkupSession()))
+    return main
@@ -0,0 +1,59 @@
+import pytest
+from aiogram import methods
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+
+from conftest import import_main
+
+
+@pytest.fixture(scope="module")
+def main(tmp_path_factory):
+    with pytest.MonkeyPatch.context() as mp:
+        yield import_main(mp, tmp_path_factory.mktemp("db"))
+
+
+@pytest.fixture(params=["main_admin", "main_user", "admin", "back", "details", "details_registered"])
+def markup(request, main):
+    keyboard = {
+        "main_admin": lambda: main.get_main_keyboard(True),
+        "main_user": lambda: main.get_main_keyboard(False),
+        "admin": main.get_admin_keyboard,
+        "back": main.get_back_keyboard,
+        "details": lambda: main.get_event_details_keyboard(5, False),
+        "details_registered": lambda: main.get_event_details_keyboard(5, True),
+    }[request.param]()
+    # Иначе сравнение прошло бы и без готового JSON
+    assert id(keyboard) in main.keyboards.payloads
+    return keyboard
+
+
+def send_message(markup):
+    return methods.SendMessage(chat_id=1, text="<b>Привет</b>", parse_mode="HTML", reply_markup=markup)
+
+
+def form_fields(form):
+    return sorted((options["name"], value) for options, _, value in form._fields)
+
+
+def writer_fields(writer):
+    return sorted((part.headers["Content-Disposition"], part._value) for part, *_ in writer._parts)
+
+
+def test_session_form_matches_aiogram(main, markup):
+    cached = main.bot.session.build_form_data(main.bot, send_message(markup))
+    plain = AiohttpSession().build_form_data(main.bot, send_message(markup))
+    assert form_fields(cached) == form_fields(plain)
+
+
+def test_webhook_response_matches_aiogram(main, markup):
+    cached = main.CachedMarkupRequestHandler(dispatcher=main.dp, bot=main.bot)
+    plain = SimpleRequestHandler(dispatcher=main.dp, bot=main.bot)
+    method = send_message(markup)
+    assert writer_fields(cached._build_response_writer(main.bot, method)) == \
+        writer_fields(plain._build_response_writer(main.bot, method))
+
+
+def test_uncached_markup_is_untouched(main):
+    markup = main.get_event_details_keyboard.__wrapped__(7, False)
+    method = send_message(markup)
+    assert main.detach_cached_markup(method) == (method, None)
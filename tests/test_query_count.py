@@ -0,0 +1,117 @@
+import asyncio
+import itertools
+from datetime import date, datetime, timedelta
+
+import pytest
+from aiogram import methods
+from aiogram.types import CallbackQuery, Chat, Document, Message, Update, User as TgUser
+from sqlalchemy import event as sa_event
+
+from conftest import import_main
+
+ADMIN_ID = 1
+PARTICIPANTS = 50
+ids = itertools.count(1000)
+
+
+@pytest.fixture(scope="module")
+def main(tmp_path_factory):
+    with pytest.MonkeyPatch.context() as mp:
+        main = import_main(mp, tmp_path_factory.mktemp("db"), ADMIN_ID)
+
+        async def make_request(self, bot, method, timeout=None):
+            # Bot API не вызывается, ответы минимальные
+            if isinstance(method, methods.AnswerCallbackQuery):
+                return True
+            chat = Chat(id=method.chat_id, type="private")
+            document = None
+            if isinstance(method, methods.SendDocument):
+                file_id = f"file{next(ids)}"
+                document = Document(file_id=file_id, file_unique_id=file_id)
+            return Message(message_id=next(ids), date=datetime.now(), chat=chat, document=document)
+
+        mp.setattr(main.AiohttpSession, "make_request", make_request)
+        yield main
+
+
+@pytest.fixture(scope="module")
+def run(main):
+    # Соединения aiosqlite привязаны к циклу, поэтому цикл один на модуль
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(main.init_db())
+    yield loop.run_until_complete
+    loop.run_until_complete(main.engine.dispose())
+    loop.close()
+
+
+def count_queries(main, run, coro):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    sa_event.listen(main.engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        run(coro)
+    finally:
+        sa_event.remove(main.engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+    return len(statements)
+
+
+async def add_registrations(main, events, users):
+    # Создает events мероприятий и записывает на каждое users новых пользователей
+    async with main.Session() as session:
+        created = [main.Event(title=f"Мероприятие {next(ids)}", topic="Тема", description="Описание",
+                              date=date.today() + timedelta(days=3), registrations_count=len(users))
+                   for _ in range(events)]
+        people = [main.User(tg_id=tg_id, full_name=f"Участник {tg_id}") for tg_id in users]
+        session.add_all(created + people)
+        await session.flush()
+        session.add_all([main.Registration(user_id=user.id, event_id=event.id) for event in created for user in people])
+        await session.commit()
+        return [event.id for event in created]
+
+
+def callback_update(data, user_id=ADMIN_ID):
+    user = TgUser(id=user_id, is_bot=False, first_name="Тест")
+    message = Message(message_id=next(ids), date=datetime.now(), chat=Chat(id=user_id, type="private"), text="x")
+    return Update(update_id=next(ids), callback_query=CallbackQuery(
+        id=str(next(ids)), from_user=user, chat_instance="test", message=message, data=data))
+
+
+def message_update(text, user_id):
+    user = TgUser(id=user_id, is_bot=False, first_name="Тест")
+    return Update(update_id=next(ids), message=Message(
+        message_id=next(ids), date=datetime.now(), chat=Chat(id=user_id, type="private"), from_user=user, text=text))
+
+
+def event_queries(main, run, participants, make_coro):
+    users = [next(ids) for _ in range(participants)]
+    event_id, = run(add_registrations(main, 1, users))
+    return count_queries(main, run, make_coro(event_id))
+
+
+@pytest.mark.parametrize("prefix", ["users_", "export_"])
+def test_admin_event_handlers(main, run, prefix):
+    def handle(event_id):
+        return main.dp.feed_update(main.bot, callback_update(f"{prefix}{event_id}"))
+
+    # Первый вызов прогревает кэш администратора
+    event_queries(main, run, 1, handle)
+    assert event_queries(main, run, 1, handle) == event_queries(main, run, PARTICIPANTS, handle)
+
+
+def test_reminders(main, run):
+    def remind(event_id):
+        return main.send_event_reminders(event_id, "1d")
+
+    assert event_queries(main, run, 1, remind) == event_queries(main, run, PARTICIPANTS, remind)
+
+
+def test_my_events(main, run):
+    def my_events_queries(events):
+        user_id = next(ids)
+        run(add_registrations(main, events, [user_id]))
+        return count_queries(main, run, main.dp.feed_update(main.bot, message_update("🎫 Мои записи", user_id)))
+
+    assert my_events_queries(1) == my_events_queries(main.PAGE_SIZE)